@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of record readers.
+
+"""
+
+import sys
+import argparse
+import time
+import pysows
+
+def lineRecordReader(f, separator=None):
+    """
+    Per-line record reader which pysows.recordReader() used to be.
+
+    f :: file
+    separator :: str
+    return :: generator(tuple(str))
+
+    """
+    for line in f:
+        line = line.rstrip()
+        yield tuple(line.split(separator))
+
+def countRecords(recG):
+    """
+    recG :: generator(tuple(str))
+    return :: int
+
+    """
+    n = 0
+    for rec in recG:
+        n += 1
+    return n
+
+def countRecordBatches(recLG):
+    """
+    recLG :: generator([tuple(str)])
+    return :: int
+
+    """
+    n = 0
+    for recL in recLG:
+        for rec in recL:
+            n += 1
+    return n
+
+READERS = [
+    ('line', lambda f, sep: countRecords(lineRecordReader(f, sep))),
+    ('recordReader', lambda f, sep: countRecords(pysows.recordReader(f, sep))),
+    ('recordBatchReader', lambda f, sep: countRecordBatches(pysows.recordBatchReader(f, sep))),
+    ]
+
+def parseOpts(argStrs):
+    """
+    argStrs :: [str]
+        argument string list.
+    return :: argparse.Namespace
+
+    """
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of record readers on a file.")
+    pysows.setVersion(parser)
+    parser.add_argument('input_file', metavar='FILE',
+                        help='Input file.')
+    parser.add_argument("-s", "--separator", metavar='SEP', dest="separator", default=None,
+                        help="Record separator (default: spaces).")
+    parser.add_argument("-r", "--repeat", metavar='N', dest="repeat", type=int, default=5,
+                        help="The best time of N runs is reported. (default: 5)")
+    return parser.parse_args(argStrs)
+
+def doMain():
+    args = parseOpts(sys.argv[1:])
+    base = None
+    for name, run in READERS:
+        best = None
+        for _ in xrange(args.repeat):
+            with open(args.input_file) as f:
+                t0 = time.clock()
+                n = run(f, args.separator)
+                t = time.clock() - t0
+            if best is None or t < best:
+                best = t
+        if base is None:
+            base = best
+        print "%-20s %8d records %8.3f sec %10.0f records/sec %5.2fx" \
+            % (name, n, best, n / max(best, 1e-9), base / max(best, 1e-9))
+
+if __name__ == "__main__":
+    try:
+        doMain()
+    except Exception, e:
+        pysows.exitWithError(e)
@@ -8,8 +8,16 @@ Filter a list of record as an input strem.
 
 import sys
 import re
+import sre_parse
+import sre_constants
+import ast
+import array
+import collections
 import argparse
 import pysows
+import sketch
+
+DEFAULT_PREDICATE = 'lambda *xs:True'
 
 def parseOpts(args):
     """
@@ -21,18 +29,34 @@ def parseOpts(args):
     parser = argparse.ArgumentParser(
         description="Filter a list of record as an input stream.")
     pysows.setVersion(parser)
+    pysows.setOutputSeparator(parser)
+    pysows.setJobs(parser)
     parser.add_argument("-g", "--groups", dest="group_indexes",
                         metavar='COLUMNS', default='0',
                         help=pysows.GROUPS_HELP_MESSAGE)
     parser.add_argument("-p", "--predicate", dest="predicate",
                         metavar='PREDICATE',
-                        default='lambda *xs:True',
+                        default=DEFAULT_PREDICATE,
                         help="Predicate as python code." + \
                             " This must return bool value.")
     parser.add_argument("-r", "--regex", dest="regex_list",
                         nargs='+', metavar='REGEX_PATTERN', default=None,
                         help="Regular expression." + \
                             " When both -p and -r options are specified, -r is used.")
+    parser.add_argument("-b", "--bloom", dest="bloom_file",
+                        metavar='FILE', default=None,
+                        help="Bloom filter file saved by join.py --bloom-out." +
+                        " Records whose -g columns (types are ignored) are not in it" +
+                        " are dropped before -p or -r is evaluated.")
+    parser.add_argument("--keys-file", dest="keys_file",
+                        metavar='FILE', default=None,
+                        help="Keep records whose -g columns (types are ignored)" +
+                        " equal a line of FILE. Columns of the line are split" +
+                        " by the separator.")
+    parser.add_argument("--fixed-strings", dest="fixed_strings_file",
+                        metavar='FILE', default=None,
+                        help="Keep records whose -g columns contain any line of FILE" +
+                        " as a substring. -g 0 searches the whole line.")
     parser.add_argument("-l", "--load", dest="load_file",
                         metavar='FILE', default=None,
                         help="Load python code for -p.")
@@ -44,8 +68,78 @@ def parseOpts(args):
                         help="Invert match like grep -v.")
     return parser.parse_args(args)
 
-def generateFilterByPredicate(predicateStr, convIdxL, globalNamespace, localNamespace):
+# Template of a fused filter function. __BODY__ is replaced by
+# the body of the predicate lambda or a call of the predicate.
+FILTER_TEMPLATE = """
+def filterBy(_rec_):
+    if len(_rec_) < _maxIdx_:
+        _projectConv_(_convIdxL_, _rec_)
+%s    return __BODY__
+"""
+
+def getColumnExpr(conv, idx, namespace):
+    """
+    conv :: str -> ANY
+    idx :: int
+        Column index. 0 is not allowed.
+    namespace :: dict
+        The converter is registered to this.
+    return :: str
+        Python expression of the converted column of _rec_.
+
     """
+    expr = '_rec_[%d]' % (idx - 1)
+    if conv is pysows.identity:
+        return expr
+    name = '_conv%d_' % len(namespace)
+    namespace[name] = conv
+    return '%s(%s)' % (name, expr)
+
+def getLambdaAssignments(lambdaNode, convIdxL, namespace):
+    """
+    Assign the projected columns to the parameters of a lambda.
+    Only parameters used in the lambda body are assigned.
+
+    lambdaNode :: ast.Lambda
+    convIdxL :: [(str -> ANY), int]
+    namespace :: dict
+    return :: [str] or None
+        Assignment statements. None if the lambda cannot be inlined.
+
+    """
+    argL = lambdaNode.args
+    if argL.kwarg is not None or argL.defaults or \
+            not all(isinstance(x, ast.Name) for x in argL.args):
+        return None
+    nameL = [x.id for x in argL.args]
+    usedNames = set(x.id for x in ast.walk(lambdaNode.body) if isinstance(x, ast.Name))
+    if any(idx == 0 for _, idx in convIdxL):
+        if nameL or argL.vararg is None:
+            return None
+        if argL.vararg not in usedNames:
+            return []
+        project = pysows.generateProjectConv(convIdxL)
+        namespace['_project_'] = project
+        return ['%s = _project_(_rec_)' % argL.vararg]
+    if len(convIdxL) < len(nameL) or \
+            (len(convIdxL) > len(nameL) and argL.vararg is None):
+        return None
+    exprL = [getColumnExpr(conv, idx, namespace) for conv, idx in convIdxL]
+    stmtL = ['%s = %s' % (name, expr)
+             for name, expr in zip(nameL, exprL) if name in usedNames]
+    if argL.vararg is not None and argL.vararg in usedNames:
+        restL = exprL[len(nameL):]
+        stmtL.append('%s = (%s)' % (argL.vararg, ''.join(x + ', ' for x in restL)))
+    return stmtL
+
+def generateFilterByPredicate(predicateStr, convIdxL, globalNamespace, localNamespace,
+                              invert=False):
+    """
+    Generate a filter function which fuses the projection,
+    type conversion, predicate and inversion.
+    If the predicate is a lambda expression, its body is inlined and
+    only the columns used by the body are converted.
+
     predicateStr :: str
         Predicate string.
         After evaled, predicate type must be (*xs -> bool).
@@ -55,21 +149,66 @@ def generateFilterByPredicate(predicateStr, convIdxL, globalNamespace, localName
         Global name space.
     localNamespace :: dict
         local name space.
+    invert :: bool
+        Invert the result.
     return :: tuple(str) -> bool
-        Filter function.
+        Filter function. It throws IOError for a short record.
 
     """
-    predicate = eval(predicateStr, globalNamespace, localNamespace)
-    project1 = pysows.generateProjectConv(convIdxL)
+    namespace = dict(globalNamespace)
+    namespace.update(localNamespace)
+    namespace.update({
+        '_projectConv_': pysows.projectConv, '_convIdxL_': convIdxL,
+        '_maxIdx_': max([0] + [idx for _, idx in convIdxL]),
+    })
 
-    def filterByPredicate(rec):
-        """
-        rec :: tuple(str)
-        return :: bool
+    tree = ast.parse(predicateStr.strip(), mode='eval')
+    stmtL = None
+    if isinstance(tree.body, ast.Lambda):
+        stmtL = getLambdaAssignments(tree.body, convIdxL, namespace)
+    if stmtL is not None:
+        body = tree.body.body
+    else:
+        namespace['_predicate_'] = eval(predicateStr, globalNamespace, localNamespace)
+        if any(idx == 0 for _, idx in convIdxL):
+            namespace['_project_'] = pysows.generateProjectConv(convIdxL)
+            callStr = '_predicate_(*_project_(_rec_))'
+        else:
+            callStr = '_predicate_(%s)' % ', '.join(
+                getColumnExpr(conv, idx, namespace) for conv, idx in convIdxL)
+        body = ast.parse(callStr, mode='eval').body
+        stmtL = []
+    if invert:
+        body = ast.UnaryOp(ast.Not(), body)
 
-        """
-        return predicate(*project1(rec))
-    return filterByPredicate
+    src = FILTER_TEMPLATE % ''.join('    %s\n' % stmt for stmt in stmtL)
+    module = ast.parse(src)
+    for node in ast.walk(module):
+        if isinstance(node, ast.Return):
+            node.value = body
+    ast.fix_missing_locations(module)
+    exec compile(module, '<predicate>', 'exec') in namespace
+    return namespace['filterBy']
+
+def testGenerateFilterByPredicate():
+    conv = pysows.getTypedColumnIndexList
+    def check(predicateStr, idxStr, rec, expected):
+        for invert in [False, True]:
+            filterBy = generateFilterByPredicate(predicateStr, conv(idxStr), {}, {}, invert)
+            assert bool(filterBy(rec)) == (expected != invert)
+    check('lambda x, y: x > y', 'i1,i2', ('3', '20'), False)
+    check('lambda x, y: x > 1', 'i1,2', ('3', 'a'), True)
+    check('lambda *xs: len(xs) == 2', '0', ('3', 'a'), True)
+    check('lambda *xs: True', '0', (), True)
+    check('lambda x, *xs: xs[0] + x == 3.5', 'f1,f2', ('1', '2.5'), True)
+    check('lambda x: all(x > y for y in [1, 2])', 'i1', ('3',), True)
+    check('lambda x, y=1: x > y', 'i1', ('3',), True)
+    check('cmp', '1,2', ('a', 'a'), False)
+    try:
+        generateFilterByPredicate('lambda x: True', conv('3'), {}, {})(('a',))
+        assert False
+    except IOError:
+        pass
 
 
 def generateFilterByRegex(regexStrL, convIdxL):
@@ -106,28 +245,439 @@ def generateFilterByRegex(regexStrL, convIdxL):
 
     return filterByRegex
 
-def doMain():
-    args = parseOpts(sys.argv[1:])
+WHITESPACE = ' \t\n\r\x0b\x0c'
+
+def isConfinedRegex(node, unsafeChars):
+    """
+    Check that a regex never matches a character of unsafeChars
+    and never looks outside the current position, so that it matches
+    the same inside a line as inside the column starting there.
 
+    node :: sre_parse.SubPattern or list
+    unsafeChars :: str
+    return :: bool
+
+    """
+    C = sre_constants
+    def isSafeChar(code):
+        return code > 0xff or chr(code) not in unsafeChars
+    for op, av in node:
+        if op == C.LITERAL:
+            if not isSafeChar(av):
+                return False
+        elif op == C.IN:
+            for op1, av1 in av:
+                if op1 == C.LITERAL:
+                    if not isSafeChar(av1):
+                        return False
+                elif op1 == C.RANGE:
+                    if any(av1[0] <= ord(c) <= av1[1] for c in unsafeChars):
+                        return False
+                elif op1 == C.CATEGORY and av1 == C.CATEGORY_DIGIT:
+                    if any(c.isdigit() for c in unsafeChars):
+                        return False
+                elif op1 == C.CATEGORY and av1 == C.CATEGORY_WORD:
+                    if any(c.isalnum() or c == '_' for c in unsafeChars):
+                        return False
+                else:
+                    return False
+        elif op in (C.MAX_REPEAT, C.MIN_REPEAT):
+            if not isConfinedRegex(av[2], unsafeChars):
+                return False
+        elif op == C.SUBPATTERN:
+            if not isConfinedRegex(av[1], unsafeChars):
+                return False
+        elif op == C.BRANCH:
+            if not all(isConfinedRegex(x, unsafeChars) for x in av[1]):
+                return False
+        elif op in (C.ASSERT, C.ASSERT_NOT):
+            # Lookbehind may see the previous column.
+            if av[0] != 1 or not isConfinedRegex(av[1], unsafeChars):
+                return False
+        else:
+            return False
+    return True
+
+def getLiteralPrefix(node):
+    """
+    node :: sre_parse.SubPattern
+    return :: str
+        Literal string that every match starts with.
+
+    """
+    charL = []
+    for op, av in node:
+        if op != sre_constants.LITERAL or av > 0x7f:
+            break
+        charL.append(chr(av))
+    return ''.join(charL)
+
+def generateLineFilterByRegex(regexStrL, convIdxL, separator=None):
+    """
+    Compile the regexes of -r and the separator into one pattern
+    anchored at the head of a raw line, so that lines are not split.
+    The longest literal prefix of the regexes is searched by 'in'
+    before the pattern is tried.
+    The result is the same as generateFilterByRegex().
+
+    regexStrL :: [str]
+        Regular expression string list.
+    convIdxL :: [(str -> ANY), int]
+        Column index list with converter.
+        converters will be ignored.
+    separator :: str
+        Separator string of columns in a line.
+    return :: (str -> bool) or None
+        Filter function of a line.
+        None if the regexes cannot be compiled into one pattern,
+        e.g. a regex may match the separator or uses anchors.
+
+    """
+    idxL = map(lambda (_, idx): idx, convIdxL)
+    if 0 in idxL or len(regexStrL) < len(idxL):
+        return None
+    unsafeChars = WHITESPACE if separator is None else separator
+    regexD = {}
+    literal = ''
+    for idx, regexStr in zip(idxL, regexStrL):
+        try:
+            node = sre_parse.parse(regexStr)
+        except re.error:
+            return None
+        if node.pattern.flags or not isConfinedRegex(node, unsafeChars):
+            return None
+        regexD.setdefault(idx, []).append(regexStr)
+        prefix = getLiteralPrefix(node)
+        if len(prefix) > len(literal):
+            literal = prefix
+
+    maxIdx = max(idxL)
+    if separator is None:
+        partL = [r'\s*']
+        content = r'\S+'
+        sep = r'\s+'
+    else:
+        partL = []
+        if len(separator) == 1:
+            content = '[^%s]*' % re.escape(separator)
+        else:
+            content = '(?:(?!%s).)*' % re.escape(separator)
+        sep = re.escape(separator)
+    for idx in xrange(1, maxIdx + 1):
+        partL += ['(?=%s)' % x for x in regexD.get(idx, [])]
+        if idx < maxIdx:
+            partL += [content, sep]
+        elif separator is None:
+            partL.append(r'(?=\S)')
+    try:
+        match = re.compile(''.join(partL)).match
+    except re.error:
+        return None
+
+    # Short lines raise IOError in the record filter.
+    filterByRegex = generateFilterByRegex(regexStrL, convIdxL)
+    if separator is None:
+        isLongEnough = re.compile(r'\s*(?:\S+\s+){%d}\S' % (maxIdx - 1)).match
+        def filterLine(line):
+            """
+            line :: str
+            return :: bool
+
+            """
+            if literal in line and match(line):
+                return True
+            if isLongEnough(line):
+                return False
+            return filterByRegex(tuple(line.split()))
+    else:
+        def filterLine(line):
+            """
+            line :: str
+            return :: bool
+
+            """
+            line = line.rstrip()
+            if literal in line and match(line):
+                return True
+            if line.count(separator) >= maxIdx - 1:
+                return False
+            return filterByRegex(tuple(line.split(separator)))
+    return filterLine
+
+def testGenerateLineFilterByRegex():
+    conv = pysows.getTypedColumnIndexList
+    lineL = ['a b c\n', ' ab  bc cd', 'x,y,z \n', 'a,b,c', 'a,,c', 'b,c', 'ab,x', ' \t', '']
+    for idxStr, regexStrL, separator in [
+            ('1', ['a'], None), ('3,1', ['c', r'\w'], None), ('2', ['b*'], None),
+            ('2', ['[a-c]+(?=c)|y'], ','), ('1,1', ['a', 'ab'], None),
+            ('2', ['b'], ','), ('2,3', ['', 'c'], ','), ('2', ['(?:x|y)'], '::')]:
+        filterLine = generateLineFilterByRegex(regexStrL, conv(idxStr), separator)
+        filterByRegex = generateFilterByRegex(regexStrL, conv(idxStr))
+        assert filterLine is not None
+        for line in lineL:
+            try:
+                expected = filterByRegex(tuple(line.rstrip().split(separator)))
+            except IOError:
+                expected = IOError
+            try:
+                result = filterLine(line)
+            except IOError:
+                result = IOError
+            assert result == expected, (idxStr, regexStrL, separator, line)
+    for regexStr in ['a.', 'a$', '^a', r'a\s', '(?i)a', r'(a)\1', '(?<=a)b', '[^a]']:
+        assert generateLineFilterByRegex([regexStr], conv('1')) is None
+    assert generateLineFilterByRegex(['a'], conv('0')) is None
+    assert generateLineFilterByRegex(['a,'], conv('1'), ',') is None
+
+class AhoCorasick(object):
+    """
+    Aho-Corasick automaton to find any of fixed strings in a text
+    in time linear to the text length regardless of the number of strings.
+    Trie edges of all the states are kept in one dict whose key is
+    (state << 8 | byte) to save memory.
+
+    """
+    def __init__(self, patternL):
+        """
+        patternL :: [str]
+
+        """
+        edges = {}
+        isOutL = [False]
+        for pattern in patternL:
+            s = 0
+            for b in bytearray(pattern):
+                t = edges.get((s << 8) | b)
+                if t is None:
+                    t = len(isOutL)
+                    edges[(s << 8) | b] = t
+                    isOutL.append(False)
+                s = t
+            isOutL[s] = True
+
+        childrenL = [[] for _ in isOutL]
+        for key, t in edges.iteritems():
+            childrenL[key >> 8].append((key & 0xff, t))
+        fail = array.array('l', [0]) * len(isOutL)
+        queue = collections.deque(t for _, t in childrenL[0])
+        while queue:
+            s = queue.popleft()
+            for b, t in childrenL[s]:
+                queue.append(t)
+                f = fail[s]
+                while f and ((f << 8) | b) not in edges:
+                    f = fail[f]
+                if s != 0:
+                    fail[t] = edges.get((f << 8) | b, 0)
+                # A state outputs if a suffix of it is a pattern.
+                isOutL[t] = isOutL[t] or isOutL[fail[t]]
+        self.edges = edges
+        self.fail = fail
+        self.isOut = bytearray(isOutL)
+
+    def search(self, text):
+        """
+        text :: str
+        return :: bool
+            True if any pattern occurs in text.
+
+        """
+        edges = self.edges
+        fail = self.fail
+        isOut = self.isOut
+        if isOut[0]:
+            return True
+        s = 0
+        for b in bytearray(text):
+            t = edges.get((s << 8) | b)
+            while t is None:
+                if s == 0:
+                    t = 0
+                    break
+                s = fail[s]
+                t = edges.get((s << 8) | b)
+            s = t
+            if isOut[s]:
+                return True
+        return False
+
+def testAhoCorasick():
+    ac = AhoCorasick(['he', 'she', 'his', 'hers', 'abcd', 'bc'])
+    for text in ['ushers', 'ahis', 'xxabcxx', 'hrs', 'abd', '', 'xhe']:
+        expected = any(p in text for p in ['he', 'she', 'his', 'hers', 'abcd', 'bc'])
+        assert ac.search(text) == expected, text
+    assert not AhoCorasick([]).search('abc')
+    assert AhoCorasick(['']).search('')
+    assert AhoCorasick(['aab']).search('aaab')
+
+def readPatternFile(fileName):
+    """
+    fileName :: str
+    return :: [str]
+        Lines without eol.
+
+    """
+    with open(fileName) as f:
+        return [line.rstrip('\r\n') for line in f]
+
+def generateGetRawColumns(idxL, separator=None):
+    """
+    idxL :: [int]
+        Key column index list. 0 means all columns.
+    separator :: str
+    return :: str -> str throws IOError
+        line -> key columns joined by '\\0'.
+        Short lines raise IOError like projection of records.
+
+    """
+    getRawKey = pysows.generateGetRawKey(idxL, separator)
+    project1 = pysows.generateProject(idxL)
+    def getRawColumns(line):
+        """
+        line :: str
+        return :: str
+
+        """
+        key = getRawKey(line)
+        if key is None:
+            project1(tuple(line.rstrip().split(separator)))
+        return key
+    return getRawColumns
+
+def generateLineFilterByKeys(keysFileName, idxL, separator=None):
+    """
+    keysFileName :: str
+        A line of the file is a key. Columns of the key are split by separator.
+    idxL :: [int]
+        Key column index list. 0 means all columns.
+    separator :: str
+    return :: str -> bool
+        Filter function of a line. True if the key columns are in the file.
+
+    """
+    keySet = set()
+    for line in readPatternFile(keysFileName):
+        key = line.rstrip().split(separator)
+        if key:
+            keySet.add('\0'.join(key))
+    getRawColumns = generateGetRawColumns(idxL, separator)
+    return lambda line: getRawColumns(line) in keySet
+
+def generateLineFilterByBloom(bloom, idxL, separator=None):
+    """
+    bloom :: sketch.BloomFilter
+        Filter of raw keys.
+    idxL :: [int]
+        Key column index list. 0 means all columns.
+    separator :: str
+    return :: str -> bool
+        Filter function of a line. True if the key columns may be in the filter.
+
+    """
+    getRawColumns = generateGetRawColumns(idxL, separator)
+    return lambda line: bloom.mayContain(getRawColumns(line))
+
+def testGenerateLineFilterByBloom():
+    bloom = sketch.BloomFilter.create(10)
+    bloom.add('a\0b')
+    filterLine = generateLineFilterByBloom(bloom, [1, 2])
+    assert filterLine('a b c\n')
+    assert not filterLine('b a c\n')
+    try:
+        filterLine('a\n')
+        assert False
+    except IOError:
+        pass
+
+def generateLineFilterByFixedStrings(patternFileName, idxL, separator=None):
+    """
+    patternFileName :: str
+        A line of the file is a pattern.
+    idxL :: [int]
+        Column index list to search. 0 means the whole line.
+    separator :: str
+    return :: str -> bool
+        Filter function of a line. True if any pattern occurs in a column.
+
+    """
+    search = AhoCorasick(readPatternFile(patternFileName)).search
+    if 0 in idxL:
+        return lambda line: search(line.rstrip())
+    # Columns are joined by '\0' which patterns do not contain.
+    getRawColumns = generateGetRawColumns(idxL, separator)
+    return lambda line: search(getRawColumns(line))
+
+def generateFilterLines(args):
+    """
+    args :: argparse.Namespace
+    return :: [str] -> [tuple(str)]
+        lines -> records which pass.
+
+    """
     convIdxL = pysows.getTypedColumnIndexList(args.group_indexes)
+    idxL = map(lambda (_, idx): idx, convIdxL)
 
     g = globals()
     l = locals()
     pysows.loadPythonCodeFile(args.load_file, g, l)
 
-    if args.regex_list is None:
-        filterBy = generateFilterByPredicate(args.predicate, convIdxL, g, l)
+    # Filters of raw lines. Only lines which pass all of them are split.
+    lineFilterL = []
+    if args.bloom_file is not None:
+        with open(args.bloom_file, 'rb') as f:
+            bloom = sketch.BloomFilter.load(f)
+        lineFilterL.append(generateLineFilterByBloom(bloom, idxL, args.separator))
+    if args.keys_file is not None:
+        lineFilterL.append(generateLineFilterByKeys(args.keys_file, idxL, args.separator))
+    if args.fixed_strings_file is not None:
+        lineFilterL.append(generateLineFilterByFixedStrings(args.fixed_strings_file, idxL,
+                                                            args.separator))
+
+    # Filter of records. Inversion is fused into it if there is no line filter.
+    filterBy = None
+    if args.regex_list is not None:
+        filterLine = generateLineFilterByRegex(args.regex_list, convIdxL, args.separator)
+        if filterLine is not None:
+            lineFilterL.append(filterLine)
+        else:
+            filterByRegex = generateFilterByRegex(args.regex_list, convIdxL)
+            if args.invert and not lineFilterL:
+                filterBy = lambda rec: not filterByRegex(rec)
+            else:
+                filterBy = filterByRegex
+    elif args.predicate != DEFAULT_PREDICATE or not lineFilterL:
+        filterBy = generateFilterByPredicate(args.predicate, convIdxL, g, l,
+                                             args.invert and not lineFilterL)
+
+    separator = args.separator
+    if not lineFilterL:
+        def filterLines(lineL):
+            return [rec for rec in pysows.linesToRecords(lineL, separator) if filterBy(rec)]
+        return filterLines
+
+    toRec = lambda line: tuple(line.rstrip().split(separator))
+    if filterBy is not None:
+        lineFilterL.append(lambda line: filterBy(toRec(line)))
+    if len(lineFilterL) == 1:
+        filterLine = lineFilterL[0]
     else:
-        filterBy = generateFilterByRegex(args.regex_list, convIdxL)
+        filterLine = lambda line: all(f(line) for f in lineFilterL)
     if args.invert:
-        notIfInvert = lambda x: not x
-    else:
-        notIfInvert = lambda x: x
+        return lambda lineL: [toRec(line) for line in lineL if not filterLine(line)]
+    return lambda lineL: [toRec(line) for line in lineL if filterLine(line)]
+
+def doMain():
+    args = parseOpts(sys.argv[1:])
+    filterLines = generateFilterLines(args)
 
-    for rec in pysows.recordReader(sys.stdin, args.separator):
-        if notIfInvert(filterBy(rec)):
-            pysows.printList(rec)
-            print
+    if args.jobs > 1:
+        for text in pysows.parallelProcessLines(filterLines, sys.stdin, args.jobs,
+                                                args.output_separator):
+            sys.stdout.write(text)
+        return
+    with pysows.RecordWriter(sys.stdout, args.output_separator) as writer:
+        for lineL in pysows.lineBatchReader(sys.stdin):
+            writer.writeBatch(filterLines(lineL))
 
 if __name__ == "__main__":
     try:
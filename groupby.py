@@ -10,7 +10,11 @@ import sys
 import argparse
 from decimal import Decimal
 import re
+import math
+import heapq
 import pysows
+import sketch
+import util
 from util import verify_type, unzip
 
 
@@ -18,15 +22,31 @@ class Accumulator(object):
     '''
     Base class or acumulator.
     '''
+    # False if the state grows with records. See memoryBytes().
+    fixedSize = True
+
     def __init__(self):
         pass
 
+    def memoryBytes(self):
+        '''
+        Rough memory cost of the accumulator and its state.
+        '''
+        return 200
+
     def add(self, s):
         raise RuntimeError('Not Implemented')
 
     def get(self):
         raise RuntimeError('Not Implemented')
 
+    def merge(self, rhs):
+        '''
+        Merge the state of another accumulator of the same kind.
+        rhs must have seen records that come after the ones self has seen.
+        '''
+        raise RuntimeError('Not Implemented')
+
 
 class AccSum(Accumulator):
     '''
@@ -42,6 +62,9 @@ class AccSum(Accumulator):
     def get(self):
         return self.v
 
+    def merge(self, rhs):
+        self.v += rhs.v
+
 
 class AccAvg(Accumulator):
     '''
@@ -59,6 +82,10 @@ class AccAvg(Accumulator):
     def get(self):
         return self.v / Decimal(self.c)
 
+    def merge(self, rhs):
+        self.c += rhs.c
+        self.v += rhs.v
+
 
 class AccMin(Accumulator):
     '''
@@ -78,6 +105,10 @@ class AccMin(Accumulator):
     def get(self):
         return self.v
 
+    def merge(self, rhs):
+        if rhs.v is not None and (self.v is None or self.v > rhs.v):
+            self.v = rhs.v
+
 
 class AccMax(Accumulator):
     '''
@@ -97,24 +128,473 @@ class AccMax(Accumulator):
     def get(self):
         return self.v
 
+    def merge(self, rhs):
+        if rhs.v is not None and (self.v is None or self.v < rhs.v):
+            self.v = rhs.v
+
+
+class AccSumInt(Accumulator):
+    '''
+    sum accumulator of int values.
+    '''
+    def __init__(self):
+        self.v = 0
+
+    def add(self, s):
+        self.v += int(s)
+
+    def get(self):
+        return self.v
+
+    def merge(self, rhs):
+        self.v += rhs.v
+
+
+class AccAvgInt(Accumulator):
+    '''
+    average accumulator of int values.
+    '''
+    def __init__(self):
+        self.c = 0
+        self.v = 0
+
+    def add(self, s):
+        self.c += 1
+        self.v += int(s)
+
+    def get(self):
+        return float(self.v) / self.c
+
+    def merge(self, rhs):
+        self.c += rhs.c
+        self.v += rhs.v
+
+
+class AccMinInt(Accumulator):
+    '''
+    minimum accumulator of int values.
+    '''
+    def __init__(self):
+        self.v = None
+
+    def add(self, s):
+        v = int(s)
+        if self.v is None or self.v > v:
+            self.v = v
+
+    def get(self):
+        return self.v
+
+    def merge(self, rhs):
+        if rhs.v is not None and (self.v is None or self.v > rhs.v):
+            self.v = rhs.v
+
+
+class AccMaxInt(Accumulator):
+    '''
+    maximum accumulator of int values.
+    '''
+    def __init__(self):
+        self.v = None
+
+    def add(self, s):
+        v = int(s)
+        if self.v is None or self.v < v:
+            self.v = v
+
+    def get(self):
+        return self.v
+
+    def merge(self, rhs):
+        if rhs.v is not None and (self.v is None or self.v < rhs.v):
+            self.v = rhs.v
+
+
+def addPartial(partials, x):
+    '''
+    Add a float value to non-overlapping partial sums exactly
+    like math.fsum(). The result does not depend on the order of addition.
+
+    partials :: [float] - updated in place.
+    x :: float
+    '''
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+class AccSumFloat(Accumulator):
+    '''
+    sum accumulator of float values.
+    It is exact until the final rounding so the result
+    does not depend on the order of records.
+    '''
+    fixedSize = False
+
+    def __init__(self):
+        self.partials = []
+
+    def add(self, s):
+        addPartial(self.partials, float(s))
+
+    def get(self):
+        return math.fsum(self.partials)
+
+    def merge(self, rhs):
+        for x in rhs.partials:
+            addPartial(self.partials, x)
+
+    def memoryBytes(self):
+        return 200 + 32 * len(self.partials)
+
+
+class AccAvgFloat(AccSumFloat):
+    '''
+    average accumulator of float values.
+    '''
+    def __init__(self):
+        AccSumFloat.__init__(self)
+        self.c = 0
+
+    def add(self, s):
+        self.c += 1
+        addPartial(self.partials, float(s))
+
+    def get(self):
+        return math.fsum(self.partials) / self.c
+
+    def merge(self, rhs):
+        self.c += rhs.c
+        AccSumFloat.merge(self, rhs)
+
+
+class AccMinFloat(Accumulator):
+    '''
+    minimum accumulator of float values.
+    '''
+    def __init__(self):
+        self.v = None
+
+    def add(self, s):
+        v = float(s)
+        if self.v is None or self.v > v:
+            self.v = v
+
+    def get(self):
+        return self.v
+
+    def merge(self, rhs):
+        if rhs.v is not None and (self.v is None or self.v > rhs.v):
+            self.v = rhs.v
+
+
+class AccMaxFloat(Accumulator):
+    '''
+    maximum accumulator of float values.
+    '''
+    def __init__(self):
+        self.v = None
+
+    def add(self, s):
+        v = float(s)
+        if self.v is None or self.v < v:
+            self.v = v
+
+    def get(self):
+        return self.v
+
+    def merge(self, rhs):
+        if rhs.v is not None and (self.v is None or self.v < rhs.v):
+            self.v = rhs.v
+
+
+def parseFixed(s):
+    '''
+    Parse a decimal string as a scaled integer.
+
+    s :: str - like '-12.345'.
+    return :: (int, int) - unscaled value and scale like (-12345, 3).
+    '''
+    i, _, f = s.partition('.')
+    try:
+        return (int(i + f), len(f))
+    except ValueError:
+        # exponent notation etc.
+        d = Decimal(s)
+        exp = d.as_tuple().exponent
+        if not isinstance(exp, (int, long)):
+            raise RuntimeError('not a finite number:', s)
+        if exp >= 0:
+            return (int(d), 0)
+        return (int(d.scaleb(-exp)), -exp)
+
+
+def cmpFixed(n0, scale0, n1, scale1):
+    '''
+    Compare two scaled integers.
+
+    return :: int - like cmp().
+    '''
+    if scale0 < scale1:
+        n0 *= 10 ** (scale1 - scale0)
+    elif scale0 > scale1:
+        n1 *= 10 ** (scale0 - scale1)
+    return cmp(n0, n1)
+
+
+def testFixed():
+    assert parseFixed('-12.345') == (-12345, 3)
+    assert parseFixed('7') == (7, 0)
+    assert parseFixed('1.5E+1') == (15, 0)
+    assert parseFixed('2.5e-3') == (25, 4)
+    assert cmpFixed(15, 1, 150, 2) == 0
+    assert cmpFixed(-2, 0, -15, 1) < 0
+    acc = AccSumFixed()
+    for s in ['1', '0.25', '-3.5']:
+        acc.add(s)
+    assert str(acc.get()) == '-2.25'
+
+
+class AccSumFixed(Accumulator):
+    '''
+    sum accumulator of exact fixed point values.
+    It keeps a scaled integer instead of Decimal.
+    '''
+    def __init__(self):
+        self.v = 0
+        self.scale = 1 # like Decimal('0.0').
+
+    def add(self, s):
+        n, scale = parseFixed(s)
+        if scale == self.scale:
+            self.v += n
+        elif scale < self.scale:
+            self.v += n * 10 ** (self.scale - scale)
+        else:
+            self.v = self.v * 10 ** (scale - self.scale) + n
+            self.scale = scale
+
+    def get(self):
+        return Decimal(self.v).scaleb(-self.scale)
+
+    def merge(self, rhs):
+        if rhs.scale <= self.scale:
+            self.v += rhs.v * 10 ** (self.scale - rhs.scale)
+        else:
+            self.v = self.v * 10 ** (rhs.scale - self.scale) + rhs.v
+            self.scale = rhs.scale
+
+
+class AccAvgFixed(AccSumFixed):
+    '''
+    average accumulator of exact fixed point values.
+    '''
+    def __init__(self):
+        AccSumFixed.__init__(self)
+        self.c = 0
+
+    def add(self, s):
+        self.c += 1
+        AccSumFixed.add(self, s)
+
+    def get(self):
+        return AccSumFixed.get(self) / Decimal(self.c)
+
+    def merge(self, rhs):
+        self.c += rhs.c
+        AccSumFixed.merge(self, rhs)
+
+
+class AccMinFixed(Accumulator):
+    '''
+    minimum accumulator of exact fixed point values.
+    '''
+    def __init__(self):
+        self.s = None
+        self.n = None
+        self.scale = None
+
+    def add(self, s):
+        n, scale = parseFixed(s)
+        if self.s is None or cmpFixed(self.n, self.scale, n, scale) > 0:
+            self.s, self.n, self.scale = s, n, scale
+
+    def get(self):
+        if self.s is None:
+            return None
+        return Decimal(self.s)
+
+    def merge(self, rhs):
+        if rhs.s is not None and \
+                (self.s is None or cmpFixed(self.n, self.scale, rhs.n, rhs.scale) > 0):
+            self.s, self.n, self.scale = rhs.s, rhs.n, rhs.scale
+
+
+class AccMaxFixed(AccMinFixed):
+    '''
+    maximum accumulator of exact fixed point values.
+    '''
+    def add(self, s):
+        n, scale = parseFixed(s)
+        if self.s is None or cmpFixed(self.n, self.scale, n, scale) < 0:
+            self.s, self.n, self.scale = s, n, scale
+
+    def merge(self, rhs):
+        if rhs.s is not None and \
+                (self.s is None or cmpFixed(self.n, self.scale, rhs.n, rhs.scale) < 0):
+            self.s, self.n, self.scale = rhs.s, rhs.n, rhs.scale
+
+
+class AccCount(Accumulator):
+    '''
+    count accumulator.
+    '''
+    def __init__(self):
+        self.c = 0
+
+    def add(self, s):
+        self.c += 1
+
+    def get(self):
+        return self.c
+
+    def merge(self, rhs):
+        self.c += rhs.c
+
+
+class AccHll(Accumulator):
+    '''
+    approximate distinct count accumulator using HyperLogLog.
+    '''
+    fixedSize = False
+
+    def __init__(self, conv):
+        '''
+        conv :: str -> ANY - converter of values.
+        '''
+        self.conv = conv
+        self.hll = sketch.HyperLogLog()
+
+    def add(self, s):
+        self.hll.add(self.conv(s))
+
+    def get(self):
+        return self.hll.count()
+
+    def merge(self, rhs):
+        self.hll.merge(rhs.hll)
+
+    def memoryBytes(self):
+        return 200 + self.hll.memoryBytes()
+
+
+class AccQuantile(Accumulator):
+    '''
+    approximate quantile accumulator using KLL sketch.
+    '''
+    fixedSize = False
+
+    def __init__(self, q, conv):
+        '''
+        q :: float - quantile in [0, 1].
+        conv :: str -> ANY - converter of values.
+        '''
+        self.q = q
+        self.conv = conv
+        self.kll = sketch.KllSketch()
+
+    def add(self, s):
+        self.kll.add(self.conv(s))
+
+    def get(self):
+        return self.kll.quantile(self.q)
+
+    def merge(self, rhs):
+        self.kll.merge(rhs.kll)
+
+    def memoryBytes(self):
+        return 200 + self.kll.memoryBytes()
+
+
+# (operator, type prefix of the column) -> accumulator.
+# No prefix means Decimal values.
+ACC_DICT = {
+    ('avg', ''): AccAvg, ('sum', ''): AccSum, ('min', ''): AccMin, ('max', ''): AccMax,
+    ('avg', 'i'): AccAvgInt, ('sum', 'i'): AccSumInt,
+    ('min', 'i'): AccMinInt, ('max', 'i'): AccMaxInt,
+    ('avg', 'f'): AccAvgFloat, ('sum', 'f'): AccSumFloat,
+    ('min', 'f'): AccMinFloat, ('max', 'f'): AccMaxFloat,
+    ('avg', 'n'): AccAvgFloat, ('sum', 'n'): AccSumFloat,
+    ('min', 'n'): AccMinFloat, ('max', 'n'): AccMaxFloat,
+    ('avg', 'd'): AccAvgFixed, ('sum', 'd'): AccSumFixed,
+    ('min', 'd'): AccMinFixed, ('max', 'd'): AccMaxFixed,
+}
+
+# type prefix of the column -> converter for sketches.
+# No prefix means raw strings for 'hll' and Decimal for quantiles.
+CONV_DICT = {'i': int, 'f': float, 'n': float, 'd': Decimal}
+
+
+class AccGenerator(object):
+    '''
+    Accumulator generator with arguments.
+    This is picklable unlike lambda.
+    '''
+    def __init__(self, cls, *args):
+        self.cls = cls
+        self.args = args
+
+    def __call__(self):
+        return self.cls(*self.args)
+
 
 def parseAcc(s):
     '''
-    s :: str - like 'avg2', 'sum3' column index is 1-origin.
+    s :: str - like 'avg2', 'sum3', 'sumi3', 'hll1', 'p99:n2' column index is 1-origin.
+        The column index can have a type prefix 'i', 'f', 'n' or 'd'
+        like getTypedColumnIndexList().
+        Quantile operator 'pNN' requires ':' before the column index.
     return :: (int, Accumulator generator) - column index (0-origin) and accumulator generator.
     '''
     verify_type(s, str)
-    m = re.match('([^0-9]+)([0-9]+)', s)
+    m = re.match('(?:(avg|sum|min|max|count|hll)|p([0-9]+(?:\.[0-9]*)?)(?=:)):?([find]?)([0-9]+)$', s)
     if not m:
         raise RuntimeError('parse operator failed:', s)
     op = m.group(1)
-    idx1 = int(m.group(2))
+    prefix = m.group(3)
+    idx1 = int(m.group(4))
     if idx1 < 1:
         raise RuntimeError('bad index', op, idx1)
-    d = {'avg': AccAvg, 'sum': AccSum, 'min': AccMin, 'max': AccMax, }
-    if op not in d:
+    if op is None:
+        q = float(m.group(2)) / 100
+        if q > 1.0:
+            raise RuntimeError('bad quantile', s)
+        return (idx1 - 1, AccGenerator(AccQuantile, q, CONV_DICT.get(prefix, Decimal)))
+    if op == 'count':
+        return (idx1 - 1, AccCount)
+    if op == 'hll':
+        return (idx1 - 1, AccGenerator(AccHll, CONV_DICT.get(prefix, str)))
+    if (op, prefix) not in ACC_DICT:
         raise RuntimeError('bad operator', op, idx1)
-    return (idx1 - 1, d[op])
+    return (idx1 - 1, ACC_DICT[(op, prefix)])
+
+
+def testParseAcc():
+    assert parseAcc('sum3') == (2, AccSum)
+    assert parseAcc('mini2') == (1, AccMinInt)
+    assert parseAcc('count1') == (0, AccCount)
+    idx, gen = parseAcc('p99.5:n4')
+    acc = gen()
+    assert idx == 3 and acc.q == 0.995 and acc.conv == float
+    assert isinstance(parseAcc('hll2')[1](), AccHll)
 
 
 class AccumulatorGroup(object):
@@ -123,49 +603,380 @@ class AccumulatorGroup(object):
     '''
     def __init__(self, args):
         verify_type(args, argparse.Namespace)
-        self.convL, grpIdxL = unzip(pysows.getTypedColumnIndexList(args.groupIndexes))
-        self.grpIdxL = [x - 1 for x in grpIdxL] # convert to 0-origin.
         self.valIdxL, self.accGenL = unzip(map(parseAcc, args.valueIndexes.split(',')))
+        # Compiled projections. See pysows.generateProjectConv().
+        self._getKey = pysows.generateProjectConv(
+            pysows.getTypedColumnIndexList(args.groupIndexes))
+        self._getValues = pysows.generateProject([x + 1 for x in self.valIdxL])
         self.hashMap = {}
 
     def add(self, rec):
-        verify_type(rec, list, str)
-
         key = self._getKey(rec)
         if key not in self.hashMap:
             self.hashMap[key] = [x() for x in self.accGenL]
 
-        valL = self._getSubRecord(rec, self.valIdxL)
+        valL = self._getValues(rec)
         accL = self.hashMap[key]
         for acc, val in zip(accL, valL):
             acc.add(val)
 
+    def merge(self, hashMap):
+        '''
+        Merge partial results of later records.
+
+        hashMap :: dict(tuple(ANY), [Accumulator]) - hashMap of another AccumulatorGroup.
+        '''
+        for key, accL in hashMap.iteritems():
+            if key in self.hashMap:
+                for acc, rhs in zip(self.hashMap[key], accL):
+                    acc.merge(rhs)
+            else:
+                self.hashMap[key] = accL
+
     def iteritems(self):
         for key, accL in sorted(self.hashMap.iteritems(), key=lambda x: x[0]):
             yield list(key) + [acc.get() for acc in accL]
 
-    def _getSubRecord(self, rec, idxes):
+
+class SortedAccumulatorGroup(AccumulatorGroup):
+    '''
+    Accumulator for input sorted by the key.
+    Only the current group is kept and it is finished as soon as the key changes.
+    '''
+    def __init__(self, args):
+        AccumulatorGroup.__init__(self, args)
+        self.key = None
+        self.accL = None
+
+    def add(self, rec):
         '''
         rec :: [str] - record
-        idxes :: [int] - index list
-        return :: [str] - sub record
-        '''
-        verify_type(rec, list, str)
-        verify_type(idxes, list, [int, long])
-        ret = []
-        for i in idxes:
-            ret.append(rec[i])
+        return :: [ANY] or None - the finished group if the key changed.
+        '''
+        key = self._getKey(rec)
+        ret = None
+        if self.accL is None or key != self.key:
+            if self.accL is not None:
+                if key < self.key:
+                    raise RuntimeError('input is not sorted by the key:', self.key, key)
+                ret = self._getResult()
+            self.key = key
+            self.accL = [x() for x in self.accGenL]
+
+        valL = self._getValues(rec)
+        for acc, val in zip(self.accL, valL):
+            acc.add(val)
         return ret
 
-    def _getKey(self, rec):
+    def iteritems(self):
+        if self.accL is not None:
+            yield self._getResult()
+
+    def _getResult(self):
         '''
-        rec :: [str] - record
-        return :: tuple(ANY) - key object.
+        return :: [ANY] - the current group.
+        '''
+        return list(self.key) + [acc.get() for acc in self.accL]
+
+
+def testSortedAccumulatorGroup():
+    args = parseOpts(['--sorted', '-g', '1', '-v', 'sumi2,count2'])
+    accGrp = SortedAccumulatorGroup(args)
+    resultL = []
+    for rec in [('a', '1'), ('a', '2'), ('b', '3'), ('c', '4'), ('c', '5')]:
+        sL = accGrp.add(rec)
+        if sL is not None:
+            resultL.append(sL)
+    assert resultL == [['a', 3, 2], ['b', 3, 1]]
+    assert list(accGrp.iteritems()) == [['c', 9, 2]]
+    assert list(SortedAccumulatorGroup(args).iteritems()) == []
+    accGrp = SortedAccumulatorGroup(args)
+    accGrp.add(('b', '1'))
+    try:
+        accGrp.add(('a', '2'))
+        assert False
+    except RuntimeError:
+        pass
+
+
+def toStrL(L):
+    '''
+    Format a result in advance because str is much cheaper to pickle than Decimal.
+
+    L :: [ANY]
+    return :: [str]
+    '''
+    return [x if isinstance(x, str) else str(x) for x in L]
+
+
+class SpillAccumulatorGroup(AccumulatorGroup):
+    '''
+    Accumulator for each key with a memory budget.
+    Keys are hash-partitioned. When the budget is exceeded, the largest partition
+    is spilled to a temporary file with its partial states and its later records
+    go to the file directly. Each spilled partition is aggregated separately
+    at the end, recursively if needed.
+    Accumulators are charged by Accumulator.memoryBytes().
+    '''
+    # Rough memory cost of a key besides its accumulators.
+    ENTRY_OVERHEAD = 400
+    PARTITION_BITS = 4
+    NR_PARTITIONS = 1 << PARTITION_BITS
+    MAX_LEVEL = 64 // PARTITION_BITS - 1
+
+    def __init__(self, args, bufferSize, tmpDir=None, level=0):
+        '''
+        args :: argparse.Namespace
+        bufferSize :: int - memory budget in bytes.
+        tmpDir :: str - directory for temporary files.
+        level :: int - recursion level. This selects the bits of the hash.
         '''
-        L = []
-        for conv, col in zip(self.convL, self._getSubRecord(rec, self.grpIdxL)):
-            L.append(conv(col))
-        return tuple(L)
+        AccumulatorGroup.__init__(self, args)
+        self.args = args
+        self.bufferSize = bufferSize
+        self.tmpDir = tmpDir
+        self.level = level
+        accL = [x() for x in self.accGenL]
+        # Memory cost of a new key.
+        self.entrySize = self.ENTRY_OVERHEAD + sum(acc.memoryBytes() for acc in accL)
+        # Indexes of accumulators whose state grows.
+        self.growIdxL = [j for j, acc in enumerate(accL) if not acc.fixedSize]
+        self.hashMapL = [{} for _ in xrange(self.NR_PARTITIONS)]
+        self.spillL = [None] * self.NR_PARTITIONS
+        self.sizeL = [0] * self.NR_PARTITIONS
+        self.size = 0
+        self.hashMap = None
+
+    def add(self, rec):
+        key = self._getKey(rec)
+        i = self._partition(key)
+        if self.spillL[i] is not None:
+            self.spillL[i].append((None, rec))
+            return
+
+        hashMap = self.hashMapL[i]
+        accL = hashMap.get(key)
+        size = 0
+        if accL is None:
+            accL = [x() for x in self.accGenL]
+            hashMap[key] = accL
+            size = self.entrySize
+        if self.growIdxL:
+            size -= self._growingSize(accL)
+
+        valL = self._getValues(rec)
+        for acc, val in zip(accL, valL):
+            acc.add(val)
+        if self.growIdxL:
+            size += self._growingSize(accL)
+        if size:
+            self._grow(i, size) # this may spill the partition.
+
+    def merge(self, hashMap):
+        for key, accL in hashMap.iteritems():
+            self._addState(key, accL)
+
+    def _addState(self, key, accL):
+        '''
+        Merge partial states of a key.
+
+        key :: tuple(ANY)
+        accL :: [Accumulator]
+        '''
+        i = self._partition(key)
+        if self.spillL[i] is not None:
+            self.spillL[i].append((key, accL))
+            return
+        hashMap = self.hashMapL[i]
+        if key in hashMap:
+            lhsL = hashMap[key]
+            size = -self._growingSize(lhsL)
+            for acc, rhs in zip(lhsL, accL):
+                acc.merge(rhs)
+            size += self._growingSize(lhsL)
+        else:
+            hashMap[key] = accL
+            size = self.ENTRY_OVERHEAD + sum(acc.memoryBytes() for acc in accL)
+        if size:
+            self._grow(i, size)
+
+    def _growingSize(self, accL):
+        '''
+        accL :: [Accumulator]
+        return :: int - memory cost of the accumulators whose state grows.
+        '''
+        return sum(accL[j].memoryBytes() for j in self.growIdxL)
+
+    def _partition(self, key):
+        '''
+        key :: tuple(ANY)
+        return :: int - partition index. Each level uses different bits of the hash.
+        '''
+        return (pysows.hash64(key) >> (self.PARTITION_BITS * self.level)) % self.NR_PARTITIONS
+
+    def _grow(self, i, size):
+        '''
+        i :: int - partition index.
+        size :: int - bytes added to the partition. This may be negative.
+        '''
+        self.sizeL[i] += size
+        self.size += size
+        if self.size > self.bufferSize and self.level < self.MAX_LEVEL:
+            self._spill()
+
+    def _spill(self):
+        '''
+        Spill the largest partition in memory.
+        '''
+        i = max(xrange(self.NR_PARTITIONS), key=lambda j: self.sizeL[j])
+        hashMap = self.hashMapL[i]
+        f = pysows.SpillFile(self.tmpDir, 'pysows-groupby-')
+        f.extend(hashMap.iteritems())
+        self.spillL[i] = f
+        self.size -= self.sizeL[i]
+        self.sizeL[i] = 0
+        self.hashMapL[i] = {}
+
+    def _sortedItems(self):
+        '''
+        return :: generator((tuple(ANY), [ANY])) - key and result sorted by key.
+        '''
+        if not any(self.spillL):
+            for key, accL in sorted((item for hashMap in self.hashMapL
+                                     for item in hashMap.iteritems()),
+                                    key=lambda x: x[0]):
+                yield key, list(key) + [acc.get() for acc in accL]
+            return
+
+        # Partitions in memory are written first,
+        # so that each child can use the whole budget.
+        runL = []
+        for i in xrange(self.NR_PARTITIONS):
+            if self.spillL[i] is None:
+                run = pysows.SpillFile(self.tmpDir, 'pysows-groupby-')
+                run.extend((key, toStrL(list(key) + [acc.get() for acc in accL]))
+                           for key, accL in sorted(self.hashMapL[i].iteritems(),
+                                                   key=lambda x: x[0]))
+                self.hashMapL[i] = {}
+                runL.append(run)
+        self.sizeL = [0] * self.NR_PARTITIONS
+        self.size = 0
+        for i in xrange(self.NR_PARTITIONS):
+            if self.spillL[i] is not None:
+                child = SpillAccumulatorGroup(self.args, self.bufferSize,
+                                              self.tmpDir, self.level + 1)
+                for key, item in self.spillL[i]:
+                    if key is None:
+                        child.add(item)
+                    else:
+                        child._addState(key, item)
+                self.spillL[i] = None
+                run = pysows.SpillFile(self.tmpDir, 'pysows-groupby-')
+                run.extend((key, toStrL(result)) for key, result in child._sortedItems())
+                del child
+                runL.append(run)
+        # Each key belongs to one partition so results never tie.
+        for item in heapq.merge(*[iter(run) for run in runL]):
+            yield item
+
+    def iteritems(self):
+        for _, result in self._sortedItems():
+            yield result
+
+
+def getTestGroupRecords():
+    '''
+    return :: [(str, str, str)] - records of many keys with int and float values.
+    '''
+    return [('k%d' % (i * 7 % 300), str(i % 13), '%d.%d' % (i % 5, i % 9))
+            for i in xrange(2000)]
+
+
+TEST_GROUP_VALUES = 'sumi2,avgi2,mini2,maxi2,sumf3,avgf3,minf3,maxf3,' \
+    'sum3,avg3,min3,max3,sumd3,avgd3,mind3,maxd3,count1,hll2,p50:i2'
+
+
+def testAccumulatorMerge():
+    recL = getTestGroupRecords()
+    for s in TEST_GROUP_VALUES.split(','):
+        idx, accGen = parseAcc(s)
+        whole = accGen()
+        for rec in recL:
+            whole.add(rec[idx])
+        accL = [accGen() for _ in xrange(3)]
+        for i, rec in enumerate(recL):
+            accL[i * 3 // len(recL)].add(rec[idx])
+        lhs = accGen()
+        for acc in accL:
+            lhs.merge(acc)
+        assert str(lhs.get()) == str(whole.get()), (s, lhs.get(), whole.get())
+        lhs.merge(accGen()) # merging an empty state changes nothing.
+        assert str(lhs.get()) == str(whole.get()), s
+
+
+def testAccumulatorGroupMerge():
+    args = parseOpts(['-g', '1', '-v', TEST_GROUP_VALUES])
+    recL = getTestGroupRecords()
+    whole = AccumulatorGroup(args)
+    for rec in recL:
+        whole.add(rec)
+    accGrp = AccumulatorGroup(args)
+    for rec in recL[:700]:
+        accGrp.add(rec)
+    rhs = AccumulatorGroup(args)
+    for rec in recL[700:]:
+        rhs.add(rec)
+    accGrp.merge(rhs.hashMap)
+    assert map(toStrL, accGrp.iteritems()) == map(toStrL, whole.iteritems())
+
+
+def testSpillAccumulatorGroup():
+    args = parseOpts(['-g', '1', '-v', TEST_GROUP_VALUES])
+    recL = getTestGroupRecords()
+    whole = AccumulatorGroup(args)
+    for rec in recL:
+        whole.add(rec)
+    expected = map(toStrL, whole.iteritems())
+
+    # Only 8 keys fit in memory so partitions of the child groups spill too.
+    bufferSize = SpillAccumulatorGroup(args, 0).entrySize * 8
+    accGrp = SpillAccumulatorGroup(args, bufferSize)
+    for rec in recL:
+        accGrp.add(rec)
+    assert any(accGrp.spillL)
+    assert map(toStrL, accGrp.iteritems()) == expected
+
+    # Records and partial states in input order like the parallel path.
+    accGrp = SpillAccumulatorGroup(args, bufferSize)
+    for i in xrange(0, len(recL), 500):
+        part = AccumulatorGroup(args)
+        for rec in recL[i:i + 500]:
+            part.add(rec)
+        if i % 1000 == 0:
+            accGrp.merge(part.hashMap)
+        else:
+            for rec in recL[i:i + 500]:
+                accGrp.add(rec)
+    assert any(accGrp.spillL)
+    assert map(toStrL, accGrp.iteritems()) == expected
+
+    # Without spilling. Growing states are charged as they grow.
+    accGrp = SpillAccumulatorGroup(args, 1 << 30)
+    for i in xrange(0, len(recL), 500):
+        part = AccumulatorGroup(args)
+        for rec in recL[i:i + 500]:
+            part.add(rec)
+        accGrp.merge(part.hashMap)
+        for rec in recL[i:i + 500]:
+            accGrp.add(rec)
+    assert not any(accGrp.spillL)
+    size = sum(accGrp.ENTRY_OVERHEAD + sum(acc.memoryBytes() for acc in accL)
+               for hashMap in accGrp.hashMapL for accL in hashMap.itervalues())
+    assert accGrp.size == sum(accGrp.sizeL) == size
+    assert size > accGrp.entrySize * len(expected) + 1000 * len(expected)
+    accGrp = SpillAccumulatorGroup(args, 1 << 30)
+    accGrp.merge(whole.hashMap)
+    assert map(toStrL, accGrp.iteritems()) == expected
 
 
 def parseOpts(args):
@@ -179,22 +990,128 @@ def parseOpts(args):
     p.add_argument("-v", "--values", dest="valueIndexes",
                    metavar='COLUMNS', default='avg2',
                    help=("List of operator and column index for target separated by comma, \n" +
-                         "like avg2,min2,max2. Operator is one of 'avg', 'sum', 'min' or 'max'."))
+                         "like avg2,min2,max2. Operator is one of 'avg', 'sum', 'min' or 'max'.\n" +
+                         "The column index can have a prefix 'i' (int), 'f' or 'n' (float)\n" +
+                         "or 'd' (exact fixed point) like sumi2. No prefix means Decimal.\n" +
+                         "Bounded-memory operators: 'count' (number of records),\n" +
+                         "'hll' (approximate distinct count) and 'pNN' (approximate\n" +
+                         "NN-th percentile, which needs ':' before the column like p99:n2)."))
     p.add_argument("-s", "--separator", dest="separator",
                    metavar='SEP', default=None,
                    help="Record separator (default: spaces).")
+    pysows.setOutputSeparator(p)
+    p.add_argument("--sorted", dest="isSorted", action="store_true", default=False,
+                   help="Input is sorted by the group columns in ascending order." +
+                   " Each group is output as soon as the key changes with constant memory.")
+    p.add_argument("-j", "--parallel", dest="parallel", type=int,
+                   metavar='N', default=1,
+                   help="Number of worker processes that aggregate chunks of input." +
+                   " Partial results are merged in input order. (default: 1)")
+    p.add_argument("-S", "--buffer-size", dest="bufferSize",
+                   metavar='SIZE', default=None,
+                   help="Memory budget like '512M' or '2G'. Hash partitions are spilled" +
+                   " to temporary files when it is exceeded. (default: unlimited)")
+    p.add_argument("-T", "--temporary-directory", dest="tmpDir",
+                   metavar='DIR', default=None,
+                   help="Directory for temporary files. (default: system default)")
     return p.parse_args(args)
 
 
+# Options of parallel aggregation workers.
+workerArgs = None
+
+
+def initAggregateWorker(args):
+    '''
+    Initializer of parallel aggregation worker processes.
+
+    args :: argparse.Namespace
+    '''
+    global workerArgs
+    workerArgs = args
+
+
+def aggregateChunk(lineL):
+    '''
+    Aggregate a chunk of lines in a worker process.
+
+    lineL :: [str]
+    return :: dict(tuple(ANY), [Accumulator]) - partial hashMap.
+    '''
+    accGrp = AccumulatorGroup(workerArgs)
+    for line in lineL:
+        accGrp.add(line.rstrip().split(workerArgs.separator))
+    return accGrp.hashMap
+
+
+def createAccumulatorGroup(args):
+    '''
+    args :: argparse.Namespace
+    return :: AccumulatorGroup
+    '''
+    if args.isSorted:
+        return SortedAccumulatorGroup(args)
+    elif args.bufferSize is not None:
+        return SpillAccumulatorGroup(args, util.u2s(args.bufferSize), args.tmpDir)
+    else:
+        return AccumulatorGroup(args)
+
+
+def writeAggregation(accGrp, recLG, writer):
+    '''
+    Aggregate batches of records and write the results.
+    Groups finished during a batch are flushed at the end of the batch
+    so that they are output without waiting for the rest of the input.
+
+    accGrp :: AccumulatorGroup
+    recLG :: generator([[str]]) - batches of records.
+    writer :: pysows.RecordWriter
+    '''
+    for recL in recLG:
+        isFinished = False
+        for rec in recL:
+            sL = accGrp.add(rec)
+            if sL is not None:
+                writer.write(sL)
+                isFinished = True
+        if isFinished:
+            writer.flush()
+    for sL in accGrp.iteritems():
+        writer.write(sL)
+
+
+def testWriteAggregation():
+    import StringIO
+    args = parseOpts(['--sorted', '-g', '1', '-v', 'sumi2'])
+    f = StringIO.StringIO()
+    def recLG():
+        yield [('a', '1'), ('b', '2')]
+        # Group a is output before the next batch is read.
+        assert f.getvalue() == 'a\t1\n'
+        yield [('c', '3')]
+    with pysows.RecordWriter(f) as writer:
+        writeAggregation(SortedAccumulatorGroup(args), recLG(), writer)
+    assert f.getvalue() == 'a\t1\nb\t2\nc\t3\n'
+
+
 def doMain():
     args = parseOpts(sys.argv[1:])
-    accGrp = AccumulatorGroup(args)
-    for line in sys.stdin:
-        rec = line.rstrip().split(args.separator)
-        accGrp.add(rec)
-    for sL in accGrp.iteritems():
-        pysows.printList(sL)
-        print
+    if args.parallel > 1:
+        if args.isSorted:
+            raise RuntimeError('--sorted and --parallel can not be used together.')
+        accGrp = createAccumulatorGroup(args)
+        chunkG = pysows.lineChunkGenerator(pysows.lineBatchReader(sys.stdin))
+        for hashMap in pysows.parallelImap(aggregateChunk, chunkG, args.parallel,
+                                           initAggregateWorker, (args,)):
+            accGrp.merge(hashMap)
+        with pysows.RecordWriter(sys.stdout, args.output_separator) as writer:
+            for sL in accGrp.iteritems():
+                writer.write(sL)
+        return
+
+    accGrp = createAccumulatorGroup(args)
+    with pysows.RecordWriter(sys.stdout, args.output_separator) as writer:
+        writeAggregation(accGrp, pysows.recordBatchReader(sys.stdin, args.separator), writer)
 
 
 if __name__ == "__main__":
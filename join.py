@@ -4,14 +4,37 @@
 """
 Join two input streams, left and right.
 Left input will be load to memory as hash index.
-This tool provide inner join. Join key must be unique but need not be sorted.
+This tool provide inner, outer, semi and anti joins.
+Join key need not be sorted.
 
 """
 
 import sys
+import os
 import argparse
 import re
+import mmap
+import struct
+import array
+import heapq
+import itertools
 import pysows
+import sketch
+import util
+
+# Rough memory cost of a record and a column in the hash table.
+RECORD_OVERHEAD = 200
+COLUMN_OVERHEAD = 40
+
+JOIN_TYPES = ['inner', 'left', 'right', 'full', 'semi', 'anti']
+
+# Columns of keys and records in the in-memory hash table are joined by this.
+# It is the same as pysows.generateGetRawKey() and sketch.BloomFilter keys.
+COLUMN_JOINER = '\0'
+
+PARTITION_BITS = 4
+NR_PARTITIONS = 1 << PARTITION_BITS
+MAX_LEVEL = 64 // PARTITION_BITS - 1
 
 def getColumnIndexListWithPrefix(keyColsWithPrefix):
     """
@@ -49,24 +72,32 @@ def prefixToIsLeft((prefix, idx)):
     else:
         raise IOError("prefix must be 'l' or 'r' but '%s'" % prefix)
 
-def generateGetOutputRecord(outColumnIndexes):
+def generateGetOutputRecord(outColumnIndexes, lNullRecord=None, rNullRecord=None):
     """
     Generate getOutputRecord function.
 
     outColumnIndexes ::  [(bool, int)]
        list of isLeft and column index.
+    lNullRecord :: tuple(str)
+       Used instead of a missing left record of outer joins.
+    rNullRecord :: tuple(str)
+       Used instead of a missing right record of outer joins.
     return :: (tuple(rec), tuple(rec)) -> tuple(rec)
         merge left record and right record to a record.
 
     """
     def getOutputRecord(leftRecord, rightRecord):
         """
-        leftRecord :: tuple(str)
-        rightRecord :: tuple(str)
+        leftRecord :: tuple(str) or None
+        rightRecord :: tuple(str) or None
         return :: tuple(str)
             merged record.
 
         """
+        if leftRecord is None:
+            leftRecord = lNullRecord
+        if rightRecord is None:
+            rightRecord = rNullRecord
         ret = []
         for isLeft, idx in outColumnIndexes:
             if isLeft:
@@ -82,6 +113,60 @@ def generateGetOutputRecord(outColumnIndexes):
         return tuple(ret)
     return getOutputRecord
 
+def getNullRecord(width, idxL, nullValue):
+    """
+    width :: int
+        Number of columns of a record of the side.
+    idxL :: [int]
+        Output column indexes of the side.
+    nullValue :: str
+    return :: tuple(str)
+        Record of nullValue which is long enough for idxL.
+
+    """
+    return (nullValue,) * max([width] + idxL)
+
+def peekRecord(recordReader):
+    """
+    recordReader :: generator(tuple(str))
+    return :: (tuple(str) or None, generator(tuple(str)))
+        The first record, None if there is none,
+        and the record reader which still yields it.
+
+    """
+    first = next(recordReader, None)
+    if first is None:
+        return None, recordReader
+    return first, itertools.chain([first], recordReader)
+
+def generateGetOuterOutputRecord(outColumnIndexes, lWidth, recordReader, nullValue):
+    """
+    Generate getOutputRecord function of outer joins.
+    The first records read from both sides decide the widths of NULL records.
+
+    outColumnIndexes :: [(bool, int)]
+       list of isLeft and column index.
+    lWidth :: int
+        Number of columns kept in the hash table of the first left record.
+        0 if the left input is empty.
+    recordReader :: generator(tuple(str))
+        Right input record reader.
+    nullValue :: str
+    return :: ((tuple(rec), tuple(rec)) -> tuple(rec), generator(tuple(str)))
+        getOutputRecord function and the right input record reader
+        which still yields the first record.
+
+    """
+    rFirst, recordReader = peekRecord(recordReader)
+    rWidth = 0
+    if rFirst is not None:
+        rWidth = len(rFirst)
+    getOutRec = generateGetOutputRecord(
+        outColumnIndexes,
+        getNullRecord(lWidth, [i for isLeft, i in outColumnIndexes if isLeft], nullValue),
+        getNullRecord(rWidth, [i for isLeft, i in outColumnIndexes if not isLeft], nullValue))
+    return getOutRec, recordReader
+
 def parseOpts(argStrs):
     """
     argStrs :: [str]
@@ -92,25 +177,72 @@ def parseOpts(argStrs):
     parser = argparse.ArgumentParser(
         description="Join two input streams." +
         " Left input will be load to memory as hash index." +
-        " This tool provide inner join. Join key must be unique but need not be sorted.")
+        " Left keys need not be unique except with -S and --index." +
+        " This tool provide inner, outer, semi and anti joins." +
+        " Join key need not be sorted.")
     pysows.setVersion(parser)
+    pysows.setOutputSeparator(parser)
     parser.add_argument('-lk', metavar='COLUMNS', dest='left_key', default='1',
                         help='Left key columns like "1,2,3". (default: 1).')
     parser.add_argument('-rk', metavar='COLUMNS', dest='right_key', default='1',
                         help='Right key columns like "1,2,3". (default: 1).')
     parser.add_argument('-jk', metavar='COLUMNS', dest='join_key', default=None,
                         help='Both -lk and -rk.')
-    parser.add_argument('-oc', metavar='COLUMNS', dest='out_columns', default='l0,r0',
+    parser.add_argument('-oc', metavar='COLUMNS', dest='out_columns', default=None,
                         help='Output columns. prefix "l" means left input, ' +
-                        '"r" means right input. (default: l0,r0)')
+                        '"r" means right input.' +
+                        ' (default: l0,r0, or r0 for semi and anti joins)')
     parser.add_argument('-li', metavar='INPUT', dest='left_input', default=None, required=True,
                         type=argparse.FileType('r'),
                         help='Left input stream. (required)')
     parser.add_argument('-ri', metavar='INPUT', dest='right_input', default=sys.stdin,
                         type=argparse.FileType('r'),
                         help='Right input stream. (default: stdin)')
+    parser.add_argument("-t", "--type", dest="join_type", default='inner',
+                        choices=JOIN_TYPES,
+                        help="Join type. left, right and full are outer joins" +
+                        " which output unmatched records of the side with NULL columns" +
+                        " of the other side. semi and anti output right records" +
+                        " whose key is or is not in the left input." +
+                        " Types other than inner require the in-memory hash table." +
+                        " (default: inner)")
+    parser.add_argument("--null", metavar='STR', dest="null_value", default='NULL',
+                        help="Column value of a missing record of outer joins." +
+                        " (default: NULL)")
     parser.add_argument("-s", "--separator", metavar='SEP', dest="separator", default=None,
                         help="Record separator (default: spaces).")
+    parser.add_argument("--sorted", action="store_true", dest="is_sorted", default=False,
+                        help="Both inputs are sorted by the key columns as strings." +
+                        " They are merge-joined with constant memory" +
+                        " and left keys need not be unique.")
+    parser.add_argument("--bloom", action="store_true", dest="bloom", default=False,
+                        help="Skip right records whose raw key columns are not in" +
+                        " a Bloom filter of left keys before splitting all the columns.")
+    parser.add_argument("--bloom-out", metavar='FILE', dest="bloom_out", default=None,
+                        help="Save the Bloom filter of left keys to FILE" +
+                        " for filter.py --bloom.")
+    parser.add_argument("--stats", action="store_true", dest="stats", default=False,
+                        help="Print the number of left rows and the memory usage" +
+                        " of the in-memory hash table to stderr." +
+                        " Only the left columns used by -oc are kept in it.")
+    parser.add_argument("--index", metavar='FILE', dest="index_file", default=None,
+                        help="Persistent hash index of the left input file." +
+                        " It is built when missing or when the left input" +
+                        " has changed its size or mtime." +
+                        " Left keys must be unique. A duplicated key raises an error.")
+    parser.add_argument("--build-index", action="store_true", dest="build_index",
+                        default=False,
+                        help="Build the index given by --index and exit.")
+    parser.add_argument("-S", "--buffer-size", metavar='SIZE', dest="buffer_size",
+                        default=None,
+                        help="Memory budget of the hash table like '512M' or '2G'." +
+                        " Both inputs are hash-partitioned to temporary files" +
+                        " when the left input exceeds it." +
+                        " Left keys must be unique. A duplicated key raises an error." +
+                        " (default: unlimited)")
+    parser.add_argument("-T", "--temporary-directory", metavar='DIR', dest="tmp_dir",
+                        default=None,
+                        help="Directory for temporary files. (default: system default)")
     args = parser.parse_args(argStrs)
     return args
 
@@ -133,26 +265,138 @@ def getKeyIndexLists(args):
                       % (len(l), len(r)))
     return (l, r)
 
-def createHashTable(recordReader, getKeyFromRecord):
+def generateGetJoinedColumns(idxL):
     """
+    idxL :: [int]
+        Column index list. 0 means all columns.
+    return :: tuple(str) -> str throws IOError.
+        record -> projected columns joined by COLUMN_JOINER.
+
+    """
+    project = pysows.generateProject(idxL)
+    joiner = COLUMN_JOINER.join
+    return lambda rec: joiner(project(rec))
+
+def unpackRecord(packed):
+    """
+    packed :: str
+        Columns joined by COLUMN_JOINER.
+    return :: tuple(str)
+
+    """
+    return tuple(packed.split(COLUMN_JOINER))
+
+def getPushdownColumns(outColumnIndexes):
+    """
+    Left columns that the hash table must keep for the output.
+
+    outColumnIndexes :: [(bool, int)]
+       list of isLeft and column index.
+    return :: ([int], [(bool, int)])
+       Left column index list to keep, and output column indexes
+       for left records projected by it.
+
+    """
+    lIdxL = sorted(set(idx for isLeft, idx in outColumnIndexes if isLeft))
+    if 0 in lIdxL:
+        return ([0], outColumnIndexes)
+    pos = dict((idx, i + 1) for i, idx in enumerate(lIdxL))
+    return (lIdxL, [(isLeft, pos[idx] if isLeft else idx)
+                    for isLeft, idx in outColumnIndexes])
+
+def testGetPushdownColumns():
+    outIdxL = [(False, 1), (True, 3), (True, 1), (True, 3)]
+    assert getPushdownColumns(outIdxL) == \
+        ([1, 3], [(False, 1), (True, 2), (True, 1), (True, 2)])
+    assert getPushdownColumns([(False, 0)]) == ([], [(False, 0)])
+    outIdxL = [(True, 0), (True, 2)]
+    assert getPushdownColumns(outIdxL) == ([0], outIdxL)
+
+def createHashTable(recordReader, getKeyFromRecord, getValueFromRecord, keyL=None):
+    """
+    Create a multimap of packed records.
+    A record of a unique key is stored as a string without a list.
+
     recordReader :: generator(tuple(str))
-    getKeyFromRecord :: tuple(str) -> tuple(str)
-    return :: dict(tuple(str), tuple(str))
-        Map of key and record.
+    getKeyFromRecord :: tuple(str) -> str
+        Key columns joined by COLUMN_JOINER.
+    getValueFromRecord :: tuple(str) -> str
+        Columns to keep joined by COLUMN_JOINER.
+    keyL :: [str]
+        Keys are appended in the order of first appearance if given.
+    return :: dict(str, str or [str])
+        Map of key and the packed record, or packed records
+        in the input order if the key is duplicated.
 
     """
     h = {}
     for rec in recordReader:
         key = getKeyFromRecord(rec)
-        if key in h:
-            raise IOError("Duplicated key: (%s)" % ','.join(key))
+        value = getValueFromRecord(rec)
+        v = h.get(key)
+        if v is None:
+            h[key] = value
+            if keyL is not None:
+                keyL.append(key)
+        elif type(v) is list:
+            v.append(value)
         else:
-            h[key] = rec
+            h[key] = [v, value]
     return h
 
+def createKeySet(recordReader, getKeyFromRecord):
+    """
+    recordReader :: generator(tuple(str))
+    getKeyFromRecord :: tuple(str) -> str
+        Key columns joined by COLUMN_JOINER.
+    return :: set(str)
+        Keys only. Records are not kept.
+
+    """
+    return set(getKeyFromRecord(rec) for rec in recordReader)
+
+def printHashTableStats(hashTable, f=sys.stderr):
+    """
+    Print the number of rows and the memory usage of a hash table.
+
+    hashTable :: dict(str, str or [str]) or set(str)
+    f :: file
+        Output stream.
+
+    """
+    nrRows = 0
+    size = sys.getsizeof(hashTable)
+    if isinstance(hashTable, dict):
+        for key, v in hashTable.iteritems():
+            size += sys.getsizeof(key) + sys.getsizeof(v)
+            if type(v) is list:
+                nrRows += len(v)
+                size += sum(map(sys.getsizeof, v))
+            else:
+                nrRows += 1
+    else:
+        nrRows = len(hashTable)
+        size += sum(map(sys.getsizeof, hashTable))
+    print >>f, "rows: %d keys: %d bytes: %d bytes/row: %.1f" \
+        % (nrRows, len(hashTable), size, float(size) / max(1, nrRows))
+
+def createBloomFilter(hashTable):
+    """
+    hashTable :: dict(str, ANY) or set(str)
+        Keys joined by COLUMN_JOINER.
+    return :: sketch.BloomFilter
+
+    """
+    bloom = sketch.BloomFilter.create(len(hashTable))
+    for key in hashTable:
+        bloom.add(key)
+    return bloom
+
 def hashJoin(hashTable, recordReader, getKeyFromRecord):
     """
-    hashTable :: dict(tuple(str), tuple(str))
+    Inner join with a table of unique keys.
+
+    hashTable :: DiskHashIndex or dict(tuple(str), tuple(str))
        Map of key and value.
     recordReader :: generator(tuple(str))
        Input record reader.
@@ -164,14 +408,635 @@ def hashJoin(hashTable, recordReader, getKeyFromRecord):
     """
     for rec in recordReader:
         key = getKeyFromRecord(rec)
-        if key in hashTable:
-            yield (hashTable[key], rec)
+        lRec = hashTable.get(key)
+        if lRec is not None:
+            yield (lRec, rec)
+
+def multiHashJoin(hashTable, recordReader, getKeyFromRecord, joinType='inner', keyL=None):
+    """
+    Join with a multimap in a single pass over the right input.
+
+    hashTable :: dict(str, str or [str])
+        Built by createHashTable().
+    recordReader :: generator(tuple(str))
+        Right input record reader.
+    getKeyFromRecord :: tuple(str) -> str
+        Get key columns joined by COLUMN_JOINER from a right record.
+    joinType :: str
+        'inner', 'left', 'right' or 'full'.
+    keyL :: [str]
+        Left keys in the input order given to createHashTable().
+        Required for 'left' and 'full'.
+    return :: generator((tuple(rec) or None, tuple(rec) or None))
+        Generator of pair of unpacked left record and right record.
+        None means a missing record of outer joins.
+        Unmatched left records follow all the others.
+
+    """
+    keepLeft = joinType in ('left', 'full')
+    keepRight = joinType in ('right', 'full')
+    matched = set()
+    for rec in recordReader:
+        key = getKeyFromRecord(rec)
+        v = hashTable.get(key)
+        if v is not None:
+            if keepLeft:
+                matched.add(key)
+            if type(v) is list:
+                for packed in v:
+                    yield (unpackRecord(packed), rec)
+            else:
+                yield (unpackRecord(v), rec)
+        elif keepRight:
+            yield (None, rec)
+    if keepLeft:
+        for key in keyL:
+            if key not in matched:
+                v = hashTable[key]
+                for packed in (v if type(v) is list else [v]):
+                    yield (unpackRecord(packed), None)
+
+def keyJoin(keySet, recordReader, getKeyFromRecord, isAnti=False):
+    """
+    Semi join or anti join.
+
+    keySet :: set(str)
+        Built by createKeySet().
+    recordReader :: generator(tuple(str))
+        Right input record reader.
+    getKeyFromRecord :: tuple(str) -> str
+        Get key columns joined by COLUMN_JOINER from a right record.
+    isAnti :: bool
+    return :: generator((None, tuple(rec)))
+        Right records whose key is in keySet, or is not in keySet if isAnti.
+
+    """
+    for rec in recordReader:
+        if (getKeyFromRecord(rec) in keySet) != isAnti:
+            yield (None, rec)
+
+def getTestJoinResult(lRecL, rRecL, outColumns, joinType='inner'):
+    """
+    Join records the way doMain() does without a budget, index or --sorted.
+
+    lRecL :: [tuple(str)]
+    rRecL :: [tuple(str)]
+    outColumns :: str
+        Like -oc.
+    joinType :: str
+    return :: [tuple(str)]
+        Output records.
+
+    """
+    outColumnIdxes = map(prefixToIsLeft, getColumnIndexListWithPrefix(outColumns))
+    getKey = generateGetJoinedColumns([1])
+    rReader = iter(rRecL)
+    if joinType in ('semi', 'anti'):
+        hashTable = createKeySet(iter(lRecL), getKey)
+        resultIter = keyJoin(hashTable, rReader, getKey, joinType == 'anti')
+        getOutRec = generateGetOutputRecord(outColumnIdxes)
+    else:
+        keyL = [] if joinType in ('left', 'full') else None
+        lIdxL, outColumnIdxes = getPushdownColumns(outColumnIdxes)
+        getValue = generateGetJoinedColumns(lIdxL)
+        lFirst, lReader = peekRecord(iter(lRecL))
+        hashTable = createHashTable(lReader, getKey, getValue, keyL)
+        getOutRec = generateGetOutputRecord(outColumnIdxes)
+        if joinType != 'inner':
+            lWidth = 0 if lFirst is None else len(unpackRecord(getValue(lFirst)))
+            getOutRec, rReader = generateGetOuterOutputRecord(
+                outColumnIdxes, lWidth, rReader, 'NULL')
+        resultIter = multiHashJoin(hashTable, rReader, getKey, joinType, keyL)
+    return [getOutRec(lRec, rRec) for lRec, rRec in resultIter]
+
+def testMultiHashJoin():
+    lRecL = [('a', 'l1', 'x'), ('b', 'l2', 'x'), ('a', 'l3', 'x'), ('c', 'l4', 'x')]
+    rRecL = [('a', 'r1'), ('d', 'r2'), ('c', 'r3'), ('a', 'r4')]
+    oc = 'r1,l2,r2'
+    inner = [('a', 'l1', 'r1'), ('a', 'l3', 'r1'), ('c', 'l4', 'r3'),
+             ('a', 'l1', 'r4'), ('a', 'l3', 'r4')]
+    assert getTestJoinResult(lRecL, rRecL, oc) == inner
+    assert getTestJoinResult(lRecL, rRecL, oc, 'left') == inner + [('NULL', 'l2', 'NULL')]
+    assert getTestJoinResult(lRecL, rRecL, oc, 'right') == \
+        inner[:2] + [('d', 'NULL', 'r2')] + inner[2:]
+    assert getTestJoinResult(lRecL, rRecL, oc, 'full') == \
+        inner[:2] + [('d', 'NULL', 'r2')] + inner[2:] + [('NULL', 'l2', 'NULL')]
+    # Only l3 is kept in the hash table. NULL records are as wide as the other side.
+    resultL = getTestJoinResult(lRecL, rRecL, 'l3,r0', 'full')
+    assert resultL[2] == ('NULL', 'd', 'r2') and resultL[-1] == ('x', 'NULL', 'NULL')
+    assert getTestJoinResult(lRecL, rRecL, 'l0,r2') == \
+        [lRecL[0] + ('r1',), lRecL[2] + ('r1',), lRecL[3] + ('r3',),
+         lRecL[0] + ('r4',), lRecL[2] + ('r4',)]
+    assert getTestJoinResult(lRecL, [], oc, 'left') == \
+        [('NULL', 'l1', 'NULL'), ('NULL', 'l3', 'NULL'), ('NULL', 'l2', 'NULL'),
+         ('NULL', 'l4', 'NULL')]
+    assert getTestJoinResult([], rRecL, oc, 'right') == \
+        [('a', 'NULL', 'r1'), ('d', 'NULL', 'r2'), ('c', 'NULL', 'r3'), ('a', 'NULL', 'r4')]
+    # Ragged left input. The first left record decides the width.
+    for n in xrange(2, 5):
+        lRecL = [('k0',) * n] + [('k%d' % i, 'l', 'x') for i in xrange(1, 100)]
+        assert getTestJoinResult(lRecL, [('z', 'r')], 'l0,r0', 'right') == \
+            [('NULL',) * n + ('z', 'r')]
+
+def testKeyJoin():
+    lRecL = [('a', 'l1'), ('b', 'l2'), ('a', 'l3')]
+    rRecL = [('a', 'r1'), ('d', 'r2'), ('b', 'r3'), ('a', 'r4')]
+    assert getTestJoinResult(lRecL, rRecL, 'r0', 'semi') == \
+        [('a', 'r1'), ('b', 'r3'), ('a', 'r4')]
+    assert getTestJoinResult(lRecL, rRecL, 'r2', 'anti') == [('r2',)]
+
+INDEX_MAGIC = 'PYSOWSIX'
+INDEX_VERSION = 1
+# magic, version, source size, source mtime, number of slots, meta length.
+INDEX_HEADER = struct.Struct('<8sIQdQI')
+# key hash and record offset + 1. Offset 0 means an empty slot.
+INDEX_SLOT = struct.Struct('<QQ')
+
+def getKeyHash(key):
+    """
+    Hash value of a key which is stable among processes.
+
+    key :: tuple(str)
+    return :: int
+        64bit value.
+
+    """
+    return pysows.stableHash64('\0'.join(key))
+
+def getIndexMeta(keyIdxL, separator):
+    """
+    keyIdxL :: [int]
+    separator :: str
+    return :: str
+        Options the index depends on.
+
+    """
+    return repr((keyIdxL, separator))
+
+def mapFile(f):
+    """
+    f :: file
+    return :: mmap.mmap or str
+        Empty string for an empty file because it cannot be mapped.
+
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return ''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def readRecord(src, off, separator=None):
+    """
+    src :: mmap.mmap or str
+    off :: int
+        Offset of the head of a line.
+    separator :: str
+    return :: tuple(str)
+
+    """
+    end = src.find('\n', off)
+    if end < 0:
+        end = len(src)
+    return tuple(src[off:end].rstrip().split(separator))
+
+def buildDiskHashIndex(srcPath, indexPath, keyIdxL, separator=None):
+    """
+    Build a persistent hash index of a file.
+    The index maps a key to the offset of the record in the source file.
+
+    srcPath :: str
+        Source file path.
+    indexPath :: str
+        Index file path.
+    keyIdxL :: [int]
+        Key column index list.
+    separator :: str
+        Column separator.
+    throws IOError if a key is duplicated.
+
+    """
+    getKey = pysows.generateProject(keyIdxL)
+    with open(srcPath, 'rb') as f:
+        st = os.fstat(f.fileno())
+        # Slots are allocated for the number of lines so that
+        # no per-record list is needed.
+        nrLines = 0
+        last = ''
+        for buf in iter(lambda: f.read(1 << 20), ''):
+            nrLines += buf.count('\n')
+            last = buf[-1]
+        if last not in ('', '\n'):
+            nrLines += 1
+        src = mapFile(f)
+
+        nrSlots = 1
+        while nrSlots < 2 * nrLines:
+            nrSlots *= 2
+        mask = nrSlots - 1
+        assert(array.array('L').itemsize == INDEX_SLOT.size // 2)
+        slots = array.array('L', [0]) * (2 * nrSlots)
+        pos = 0
+        while pos < len(src):
+            key = getKey(readRecord(src, pos, separator))
+            h = getKeyHash(key)
+            i = h & mask
+            while slots[2 * i + 1] != 0:
+                if slots[2 * i] == h and \
+                        getKey(readRecord(src, slots[2 * i + 1] - 1, separator)) == key:
+                    raise IOError("Duplicated key: (%s)" % ','.join(key))
+                i = (i + 1) & mask
+            slots[2 * i] = h
+            slots[2 * i + 1] = pos + 1
+            pos = src.find('\n', pos)
+            if pos < 0:
+                break
+            pos += 1
+
+    meta = getIndexMeta(keyIdxL, separator)
+    tmpPath = indexPath + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, st.st_size, st.st_mtime,
+                                  nrSlots, len(meta)))
+        f.write(meta)
+        slots.tofile(f)
+    os.rename(tmpPath, indexPath)
+
+class DiskHashIndex(object):
+    """
+    Memory-mapped hash index built by buildDiskHashIndex().
+    This can be used with hashJoin() instead of a dict of unique keys.
+
+    """
+    def __init__(self, srcPath, indexPath, keyIdxL, separator=None):
+        """
+        srcPath :: str
+        indexPath :: str
+        keyIdxL :: [int]
+        separator :: str
+        throws IOError if the index does not match the source file or options.
+
+        """
+        self.separator = separator
+        self.getKey = pysows.generateProject(keyIdxL)
+        with open(indexPath, 'rb') as f:
+            self.index = mapFile(f)
+        if len(self.index) < INDEX_HEADER.size:
+            raise IOError("Broken index: %s" % indexPath)
+        magic, version, size, mtime, nrSlots, metaLen = \
+            INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise IOError("Not an index: %s" % indexPath)
+        meta = self.index[INDEX_HEADER.size:INDEX_HEADER.size + metaLen]
+        if meta != getIndexMeta(keyIdxL, separator):
+            raise IOError("Index %s was built with other options: %s" % (indexPath, meta))
+        with open(srcPath, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size != size or st.st_mtime != mtime:
+                raise IOError("Index %s is stale for %s" % (indexPath, srcPath))
+            self.src = mapFile(f)
+        self.mask = nrSlots - 1
+        self.base = INDEX_HEADER.size + metaLen
+
+    def get(self, key, default=None):
+        """
+        key :: tuple(str)
+        default :: ANY
+        return :: tuple(str) or default
+
+        """
+        h = getKeyHash(key)
+        i = h & self.mask
+        while True:
+            slotHash, off = INDEX_SLOT.unpack_from(self.index, self.base + INDEX_SLOT.size * i)
+            if off == 0:
+                return default
+            if slotHash == h:
+                rec = readRecord(self.src, off - 1, self.separator)
+                if self.getKey(rec) == key:
+                    return rec
+            i = (i + 1) & self.mask
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        rec = self.get(key)
+        if rec is None:
+            raise KeyError(key)
+        return rec
+
+def openDiskHashIndex(srcPath, indexPath, keyIdxL, separator=None):
+    """
+    Open a hash index, building it if it is missing or stale.
+
+    srcPath :: str
+    indexPath :: str
+    keyIdxL :: [int]
+    separator :: str
+    return :: DiskHashIndex
+
+    """
+    if os.path.exists(indexPath):
+        try:
+            return DiskHashIndex(srcPath, indexPath, keyIdxL, separator)
+        except IOError, e:
+            print >>sys.stderr, e, "(rebuilding)"
+    buildDiskHashIndex(srcPath, indexPath, keyIdxL, separator)
+    return DiskHashIndex(srcPath, indexPath, keyIdxL, separator)
+
+def testDiskHashIndex():
+    import tempfile
+    import shutil
+    tmpDir = tempfile.mkdtemp(prefix='pysows-join-')
+    try:
+        srcPath = os.path.join(tmpDir, 'left')
+        indexPath = os.path.join(tmpDir, 'left.idx')
+        with open(srcPath, 'wb') as f:
+            f.write(''.join('k%d v%d\n' % (i, i) for i in xrange(1000)))
+            f.write('last v')
+        index = openDiskHashIndex(srcPath, indexPath, [1])
+        assert index.get(('k10',)) == ('k10', 'v10')
+        assert index[('k999',)] == ('k999', 'v999')
+        assert index.get(('last',)) == ('last', 'v')
+        assert ('k1000',) not in index
+        assert list(hashJoin(index, iter([('k3', 'a'), ('x', 'b'), ('k3', 'c')]),
+                             lambda rec: rec[:1])) == \
+            [(('k3', 'v3'), ('k3', 'a')), (('k3', 'v3'), ('k3', 'c'))]
+        try:
+            DiskHashIndex(srcPath, indexPath, [2])
+            assert False
+        except IOError:
+            pass
+
+        # A changed source makes the index stale and it is rebuilt.
+        with open(srcPath, 'ab') as f:
+            f.write('\nnew w\n')
+        try:
+            DiskHashIndex(srcPath, indexPath, [1])
+            assert False
+        except IOError:
+            pass
+        index = openDiskHashIndex(srcPath, indexPath, [1])
+        assert index.get(('new',)) == ('new', 'w')
+
+        with open(srcPath, 'ab') as f:
+            f.write('k5 dup\n')
+        try:
+            openDiskHashIndex(srcPath, indexPath, [1])
+            assert False
+        except IOError:
+            pass
+
+        with open(srcPath, 'wb') as f:
+            pass
+        index = openDiskHashIndex(srcPath, indexPath, [1])
+        assert index.get(('k1',)) is None
+    finally:
+        shutil.rmtree(tmpDir)
+
+def getRecordSize(rec):
+    """
+    rec :: tuple(str)
+    return :: int
+        Rough memory cost of the record in the hash table.
+
+    """
+    return RECORD_OVERHEAD + COLUMN_OVERHEAD * len(rec) + sum(map(len, rec))
+
+def getPartition(key, level):
+    """
+    key :: tuple(str)
+    level :: int
+        Recursion level. Each level uses different bits of the hash.
+    return :: int
+
+    """
+    return (pysows.hash64(key) >> (PARTITION_BITS * level)) % NR_PARTITIONS
+
+def graceHashJoinWithSeq(lRecG, rItemG, lGetKey, rGetKey, bufferSize, tmpDir=None, level=0):
+    """
+    Hybrid grace hash join.
+    The left input is hash-partitioned and the largest partition is spilled
+    to a temporary file whenever the budget is exceeded. Right records of
+    spilled partitions are spilled too and each pair of spilled partitions
+    is joined recursively.
+
+    lRecG :: generator(tuple(str))
+    rItemG :: generator((int, tuple(str)))
+        Right records with sequence numbers.
+    lGetKey :: tuple(str) -> tuple(str)
+    rGetKey :: tuple(str) -> tuple(str)
+    bufferSize :: int
+        Memory budget in bytes.
+    tmpDir :: str
+        Directory for temporary files.
+    level :: int
+        Recursion level.
+    return :: generator((int, tuple(str), tuple(str)))
+        Sequence number of the right record, left record and right record
+        in the order of the sequence number.
+
+    """
+    hashTableL = [{} for _ in xrange(NR_PARTITIONS)]
+    sizeL = [0] * NR_PARTITIONS
+    lSpillL = [None] * NR_PARTITIONS
+    for rec in lRecG:
+        key = lGetKey(rec)
+        i = getPartition(key, level)
+        if lSpillL[i] is not None:
+            lSpillL[i].append(rec)
+            continue
+        h = hashTableL[i]
+        if key in h:
+            raise IOError("Duplicated key: (%s)" % ','.join(key))
+        h[key] = rec
+        sizeL[i] += getRecordSize(rec)
+        if sum(sizeL) > bufferSize and level < MAX_LEVEL:
+            j = max(xrange(NR_PARTITIONS), key=lambda x: sizeL[x])
+            lSpillL[j] = pysows.SpillFile(tmpDir, 'pysows-join-')
+            lSpillL[j].extend(hashTableL[j].itervalues())
+            hashTableL[j] = {}
+            sizeL[j] = 0
+
+    if not any(lSpillL):
+        for seq, rec in rItemG:
+            key = rGetKey(rec)
+            lRec = hashTableL[getPartition(key, level)].get(key)
+            if lRec is not None:
+                yield (seq, lRec, rec)
+        return
+
+    rSpillL = [None if f is None else pysows.SpillFile(tmpDir, 'pysows-join-')
+               for f in lSpillL]
+    run = pysows.SpillFile(tmpDir, 'pysows-join-')
+    for seq, rec in rItemG:
+        key = rGetKey(rec)
+        i = getPartition(key, level)
+        if rSpillL[i] is not None:
+            rSpillL[i].append((seq, rec))
+        else:
+            lRec = hashTableL[i].get(key)
+            if lRec is not None:
+                run.append((seq, lRec, rec))
+    del hashTableL
+
+    runL = [run]
+    for lSpill, rSpill in zip(lSpillL, rSpillL):
+        if lSpill is None:
+            continue
+        run = pysows.SpillFile(tmpDir, 'pysows-join-')
+        run.extend(graceHashJoinWithSeq(iter(lSpill), iter(rSpill), lGetKey, rGetKey,
+                                        bufferSize, tmpDir, level + 1))
+        runL.append(run)
+    # Sequence numbers are unique so records are never compared.
+    for item in heapq.merge(*[iter(run) for run in runL]):
+        yield item
+
+def graceHashJoin(lReader, rReader, lGetKey, rGetKey, bufferSize, tmpDir=None):
+    """
+    Hash join with bounded memory.
+    The result is the same as the inner join of the in-memory hash table
+    with unique keys including the order.
+
+    lReader :: generator(tuple(str))
+    rReader :: generator(tuple(str))
+    lGetKey :: tuple(str) -> tuple(str)
+    rGetKey :: tuple(str) -> tuple(str)
+    bufferSize :: int
+        Memory budget in bytes.
+    tmpDir :: str
+        Directory for temporary files.
+    return :: generator((tuple(rec), tuple(rec)))
+        Generator of pair of left record and right record.
+
+    """
+    for _, lRec, rRec in graceHashJoinWithSeq(lReader, enumerate(rReader),
+                                              lGetKey, rGetKey, bufferSize, tmpDir):
+        yield (lRec, rRec)
+
+def testGraceHashJoin():
+    global graceHashJoinWithSeq
+    lRecL = [('k%d' % i, 'l%d' % i) for i in xrange(0, 3000, 2)]
+    rRecL = [('k%d' % ((i * 7919) % 4000), 'r%d' % i) for i in xrange(4000)]
+    getKey = pysows.generateProject([1])
+    hashTable = dict((getKey(rec), rec) for rec in lRecL)
+    expected = list(hashJoin(hashTable, iter(rRecL), getKey))
+    assert len(expected) > 1000
+
+    # Record the deepest recursion level.
+    levelL = []
+    joinWithSeq = graceHashJoinWithSeq
+    def recordLevel(*args):
+        # level is given positionally to recursive calls only.
+        levelL.append(args[6] if len(args) > 6 else 0)
+        return joinWithSeq(*args)
+    graceHashJoinWithSeq = recordLevel
+    try:
+        resultL = list(graceHashJoin(iter(lRecL), iter(rRecL), getKey, getKey, 2000))
+    finally:
+        graceHashJoinWithSeq = joinWithSeq
+    assert resultL == expected
+    assert max(levelL) >= 2
+
+    assert list(graceHashJoin(iter(lRecL), iter(rRecL), getKey, getKey, 1 << 30)) == expected
+    # The duplicated key goes to a spilled partition.
+    try:
+        list(graceHashJoin(iter(lRecL + [('k0', 'dup')]), iter(rRecL), getKey, getKey, 2000))
+        assert False
+    except IOError:
+        pass
+
+def sortedRunGenerator(recordReader, getKeyFromRecord, name):
+    """
+    Group a sorted record stream into runs of the same key.
+
+    recordReader :: generator(tuple(str))
+    getKeyFromRecord :: tuple(str) -> tuple(str)
+    name :: str
+        Input name for error messages.
+    return :: generator((tuple(str), [tuple(str)]))
+        Key and records of the key.
+    throws IOError if the input is not sorted.
+
+    """
+    prevKey = None
+    for key, recG in itertools.groupby(recordReader, getKeyFromRecord):
+        if prevKey is not None and key < prevKey:
+            raise IOError("%s input is not sorted: (%s) after (%s)"
+                          % (name, ','.join(key), ','.join(prevKey)))
+        prevKey = key
+        yield key, list(recG)
+
+def mergeJoin(lReader, rReader, lGetKey, rGetKey):
+    """
+    Merge join of two inputs sorted by the key.
+    Only records of one left key are kept in memory.
+    Right records are streamed so the result is in the order of the right input.
+    Both inputs are read to the end so that unsorted input is always detected.
+
+    lReader :: generator(tuple(str))
+    rReader :: generator(tuple(str))
+    lGetKey :: tuple(str) -> tuple(str)
+    rGetKey :: tuple(str) -> tuple(str)
+    return :: generator((tuple(rec), tuple(rec)))
+        Generator of pair of left record and right record.
+    throws IOError if an input is not sorted.
+
+    """
+    lRunG = sortedRunGenerator(lReader, lGetKey, "left")
+    lKey, lRecL = next(lRunG, (None, None))
+    prevKey = None
+    for rRec in rReader:
+        rKey = rGetKey(rRec)
+        if prevKey is not None and rKey < prevKey:
+            raise IOError("right input is not sorted: (%s) after (%s)"
+                          % (','.join(rKey), ','.join(prevKey)))
+        prevKey = rKey
+        while lKey is not None and lKey < rKey:
+            lKey, lRecL = next(lRunG, (None, None))
+        # The rest of the right input is still read to check its order.
+        if lKey == rKey:
+            for lRec in lRecL:
+                yield (lRec, rRec)
+    # The rest of the left input is also read to check its order.
+    for _ in lRunG:
+        pass
+
+def testMergeJoin():
+    getKey = lambda rec: rec[:1]
+    lRecL = [('a', '1'), ('b', '2'), ('b', '3'), ('d', '4')]
+    rRecL = [('a', 'x'), ('b', 'y'), ('b', 'z'), ('c', 'w'), ('d', 'v'), ('e', 'u')]
+    assert list(mergeJoin(iter(lRecL), iter(rRecL), getKey, getKey)) == [
+        (('a', '1'), ('a', 'x')),
+        (('b', '2'), ('b', 'y')), (('b', '3'), ('b', 'y')),
+        (('b', '2'), ('b', 'z')), (('b', '3'), ('b', 'z')),
+        (('d', '4'), ('d', 'v'))]
+    assert list(mergeJoin(iter([]), iter(rRecL), getKey, getKey)) == []
+    assert list(mergeJoin(iter(lRecL), iter([]), getKey, getKey)) == []
+    # Unsorted right input after the left input runs out.
+    try:
+        list(mergeJoin(iter([('a', '1'), ('b', '2')]),
+                       iter([('a', 'x'), ('c', 'y'), ('b', 'z')]), getKey, getKey))
+        assert False
+    except IOError:
+        pass
+    # Unsorted left input.
+    try:
+        list(mergeJoin(iter([('b', '1'), ('a', '2')]),
+                       iter([('a', 'x'), ('b', 'y')]), getKey, getKey))
+        assert False
+    except IOError:
+        pass
 
 def doMain():
     args = parseOpts(sys.argv[1:])
 
+    isKeyJoin = args.join_type in ('semi', 'anti')
+    if args.out_columns is None:
+        args.out_columns = 'r0' if isKeyJoin else 'l0,r0'
     outColumnIdxes = map(prefixToIsLeft,
                          getColumnIndexListWithPrefix(args.out_columns))
+    if isKeyJoin and any(isLeft for isLeft, _ in outColumnIdxes):
+        raise IOError("semi and anti joins output right columns only.")
     getOutRec = generateGetOutputRecord(outColumnIdxes)
 
     lReader = pysows.recordReader(args.left_input, args.separator)
@@ -181,12 +1046,71 @@ def doMain():
     lGetKey = pysows.generateProject(lKeyIdxL)
     rGetKey = pysows.generateProject(rKeyIdxL)
 
-    hashTable = createHashTable(lReader, lGetKey)
-    resultIter = hashJoin(hashTable, rReader, rGetKey)
+    if args.build_index or args.index_file is not None:
+        if args.index_file is None:
+            raise IOError("--build-index requires --index.")
+        if not os.path.isfile(args.left_input.name):
+            raise IOError("Left input must be a regular file to use an index.")
+    if (args.bloom or args.bloom_out is not None) and \
+            (args.index_file is not None or args.is_sorted or args.buffer_size is not None):
+        raise IOError("--bloom and --bloom-out require the in-memory hash table.")
+    if args.stats and \
+            (args.index_file is not None or args.is_sorted or args.buffer_size is not None):
+        raise IOError("--stats requires the in-memory hash table.")
+    if args.join_type != 'inner' and \
+            (args.index_file is not None or args.is_sorted or args.buffer_size is not None):
+        raise IOError("--type %s requires the in-memory hash table." % args.join_type)
+    if args.bloom and args.join_type in ('right', 'full', 'anti'):
+        raise IOError("--bloom drops unmatched right records so it cannot be used"
+                      " with --type %s." % args.join_type)
+    if args.build_index:
+        buildDiskHashIndex(args.left_input.name, args.index_file, lKeyIdxL, args.separator)
+        return
+
+    if args.index_file is not None:
+        hashTable = openDiskHashIndex(args.left_input.name, args.index_file,
+                                      lKeyIdxL, args.separator)
+        resultIter = hashJoin(hashTable, rReader, rGetKey)
+    elif args.is_sorted:
+        resultIter = mergeJoin(lReader, rReader, lGetKey, rGetKey)
+    elif args.buffer_size is None:
+        lGetJoinedKey = generateGetJoinedColumns(lKeyIdxL)
+        rGetJoinedKey = generateGetJoinedColumns(rKeyIdxL)
+        keyL = [] if args.join_type in ('left', 'full') else None
+        if isKeyJoin:
+            hashTable = createKeySet(lReader, lGetJoinedKey)
+        else:
+            lIdxL, outColumnIdxes = getPushdownColumns(outColumnIdxes)
+            getOutRec = generateGetOutputRecord(outColumnIdxes)
+            lGetValue = generateGetJoinedColumns(lIdxL)
+            lFirst, lReader = peekRecord(lReader)
+            hashTable = createHashTable(lReader, lGetJoinedKey, lGetValue, keyL)
+        if args.stats:
+            printHashTableStats(hashTable)
+        if args.bloom or args.bloom_out is not None:
+            bloom = createBloomFilter(hashTable)
+            if args.bloom_out is not None:
+                with open(args.bloom_out, 'wb') as f:
+                    bloom.save(f)
+            if args.bloom:
+                getRawKey = pysows.generateGetRawKey(rKeyIdxL, args.separator)
+                rReader = pysows.recordReader(bloom.filterLines(args.right_input, getRawKey),
+                                              args.separator)
+        if isKeyJoin:
+            resultIter = keyJoin(hashTable, rReader, rGetJoinedKey, args.join_type == 'anti')
+        else:
+            if args.join_type != 'inner':
+                lWidth = 0 if lFirst is None else len(unpackRecord(lGetValue(lFirst)))
+                getOutRec, rReader = generateGetOuterOutputRecord(
+                    outColumnIdxes, lWidth, rReader, args.null_value)
+            resultIter = multiHashJoin(hashTable, rReader, rGetJoinedKey, args.join_type, keyL)
+    else:
+        resultIter = graceHashJoin(lReader, rReader, lGetKey, rGetKey,
+                                   util.u2s(args.buffer_size), args.tmp_dir)
 
-    for lRec, rRec in resultIter:
-        pysows.printList(getOutRec(lRec, rRec))
-        print
+    with pysows.RecordWriter(sys.stdout, args.output_separator) as writer:
+        for lRec, rRec in resultIter:
+            writer.write(getOutRec(lRec, rRec))
 
 if __name__ == "__main__":
     try:
@@ -7,9 +7,20 @@ Map a function to the list of record from an input stream.
 """
 
 import sys
+import operator
 import argparse
 import pysows
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_CONSTRUCTOR = 'lambda xs,ys:list(xs)+list(ys)'
+# No mapped column outputs the records as they are like DEFAULT_CONSTRUCTOR.
+DEFAULT_BATCH_CONSTRUCTOR = ('lambda recs,cols:'
+                             '[xs+ys for xs,ys in zip(recs,zip(*cols))] if cols else list(recs)')
+
 def parseOpts(argStrList):
     """
     argStrList :: [str]
@@ -20,6 +31,8 @@ def parseOpts(argStrList):
     parser = argparse.ArgumentParser(
         description="Map a function to a list of record from an input stream.")
     pysows.setVersion(parser)
+    pysows.setOutputSeparator(parser)
+    pysows.setJobs(parser)
     parser.add_argument('-g', '--groups', metavar='COLUMNS',
                         dest='group_indexes', default='1',
                         help=pysows.GROUPS_HELP_MESSAGE)
@@ -29,40 +42,283 @@ def parseOpts(argStrList):
                             ' This must return sequence of printable objects.' + \
                             " (default: 'lambda *xs:xs')")
     parser.add_argument('-c', '--constructor', metavar='FUNCTION',
-                        dest='record_constructor',
-                        default='lambda xs,ys:list(xs)+list(ys)',
+                        dest='record_constructor', default=None,
                         help='Record constructor.' + \
                             ' This must return sequence of printable objects.' + \
-                            " (default: 'lambda xs,ys:list(xs)+list(ys)')")
+                            " (default: '%s')" % DEFAULT_CONSTRUCTOR + \
+                            ' With --batch, this gets the records and the mapped columns' + \
+                            ' of a batch and must return the output records.' + \
+                            " (default: '%s')" % DEFAULT_BATCH_CONSTRUCTOR)
     parser.add_argument('-l', '--load', metavar='FILE', dest='load_file',
                         default=None, help='Load python code for -f and -c.')
     parser.add_argument("-s", "--separator", metavar='SEP',
                         dest="separator", default=None,
                         help="Record separator (default: spaces).")
+    parser.add_argument('--memo', metavar='SIZE', dest='memo', type=int, default=0,
+                        help='Cache the results of the map function for the last SIZE' +
+                        ' distinct keys and print the hit rate to stderr.' +
+                        ' With --jobs, each worker has its own cache' +
+                        ' and the hit rate is not printed. (default: 0, no cache)')
+    parser.add_argument('--batch', metavar='N', dest='batch', type=int, default=0,
+                        help='Map N records at once. The map function gets columns' +
+                        " and must return columns. Columns with 'i', 'n' or 'f' prefix" +
+                        ' are numpy arrays if numpy is available, otherwise lists.' +
+                        ' (default: 0, record by record)')
+    parser.add_argument('--concurrency', metavar='N', dest='concurrency', type=int,
+                        default=1,
+                        help='Call the map function for N records at once in threads.' +
+                        ' This is for map functions which wait for I/O' +
+                        ' such as a local lookup service.' +
+                        ' Records are streamed and output in the input order. (default: 1)')
 
     return parser.parse_args(argStrList)
 
-def doMain():
-    args = parseOpts(sys.argv[1:])
+def loadMapFunctions(args):
+    """
+    args :: argparse.Namespace
+    return :: (ANY -> [ANY], ([ANY], [ANY]) -> [ANY], pysows.LruMemo or None)
+        (map function, record constructor, memoized map function if --memo is given)
+
+    """
+    if args.batch > 0 and args.memo > 0:
+        raise IOError("--memo cannot be used with --batch.")
+    if args.concurrency > 1 and (args.batch > 0 or args.memo > 0 or args.jobs > 1):
+        raise IOError("--concurrency cannot be used with --batch, --memo or --jobs.")
+    if args.record_constructor is None:
+        if args.batch > 0:
+            args.record_constructor = DEFAULT_BATCH_CONSTRUCTOR
+        else:
+            args.record_constructor = DEFAULT_CONSTRUCTOR
 
     g = globals()
     l = locals()
     pysows.loadPythonCodeFile(args.load_file, g, l)
     mapFunc = eval(args.map_func, g, l)
+    memo = None
+    if args.memo > 0:
+        mapFunc = memo = pysows.LruMemo(mapFunc, args.memo)
     constructor = eval(args.record_constructor, g, l)
+    return mapFunc, constructor, memo
 
+def generateMapLines(args):
+    """
+    args :: argparse.Namespace
+    return :: ([str] -> [[ANY]], pysows.LruMemo or None)
+        (lines -> output records, memoized map function if --memo is given)
+
+    """
+    mapFunc, constructor, memo = loadMapFunctions(args)
+    convIdxL = pysows.getTypedColumnIndexList(args.group_indexes)
+    assert len(convIdxL) > 0
+    getKeyFromRec = pysows.generateProjectConv(convIdxL)
+    separator = args.separator
+
+    if args.batch > 0:
+        mapBatch = generateMapBatch(mapFunc, constructor, convIdxL)
+        batchSize = args.batch
+        def mapLinesInBatches(lineL):
+            recL = pysows.linesToRecords(lineL, separator)
+            if len(recL) <= batchSize:
+                return mapBatch(recL)
+            outL = []
+            for i in xrange(0, len(recL), batchSize):
+                outL.extend(mapBatch(recL[i:i + batchSize]))
+            return outL
+        return mapLinesInBatches, memo
+
+    def mapLines(lineL):
+        return [constructor(rec, mapFunc(*getKeyFromRec(rec)))
+                for rec in pysows.linesToRecords(lineL, separator)]
+    return mapLines, memo
+
+def generateMapRecord(args):
+    """
+    args :: argparse.Namespace
+    return :: tuple(str) -> [ANY]
+        record -> output record.
+
+    """
+    mapFunc, constructor, _ = loadMapFunctions(args)
     convIdxL = pysows.getTypedColumnIndexList(args.group_indexes)
     assert len(convIdxL) > 0
     getKeyFromRec = pysows.generateProjectConv(convIdxL)
+    return lambda rec: constructor(rec, mapFunc(*getKeyFromRec(rec)))
 
-    reader = pysows.recordReader(sys.stdin, args.separator)
+def testGenerateMapRecord():
+    import SocketServer
+    import threading
+    import tempfile
+    import shutil
+    import os
+    import time
+
+    lock = threading.Lock()
+    nrLookups = [0, 0] # lookups in progress and its peak.
+
+    class LookupHandler(SocketServer.StreamRequestHandler):
+        """
+        Stand-in of a local lookup service. It answers a key in upper case slowly.
+
+        """
+        def handle(self):
+            for line in self.rfile:
+                with lock:
+                    nrLookups[0] += 1
+                    nrLookups[1] = max(nrLookups)
+                time.sleep(0.01)
+                with lock:
+                    nrLookups[0] -= 1
+                self.wfile.write(line.upper())
+                self.wfile.flush()
+
+    class LookupServer(SocketServer.ThreadingTCPServer):
+        daemon_threads = True
+        # Clients connect at once. SYN retries of a full backlog take a second.
+        request_queue_size = 64
+
+    server = LookupServer(('127.0.0.1', 0), LookupHandler)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+    # The client is a module imported by the load file,
+    # so that the test can close the connections it opened.
+    tmpDir = tempfile.mkdtemp()
+    with open(os.path.join(tmpDir, 'pysows_test_lookup.py'), 'w') as f:
+        f.write("""
+import socket
+import threading
+local = threading.local()
+openedL = []
+def lookup(key):
+    if not hasattr(local, 'f'):
+        sock = socket.create_connection(('127.0.0.1', %d))
+        local.f = sock.makefile('r+')
+        openedL.extend([local.f, sock])
+    local.f.write(key + '\\n')
+    local.f.flush()
+    return (local.f.readline().rstrip('\\n'),)
+""" % server.server_address[1])
+    loadFileName = os.path.join(tmpDir, 'load.py')
+    with open(loadFileName, 'w') as f:
+        f.write('from pysows_test_lookup import lookup\n')
+    sys.path.insert(0, tmpDir)
+    try:
+        args = parseOpts(['-l', loadFileName, '-g', '2', '-f', 'lookup',
+                          '--concurrency', '16'])
+        recL = [(str(i), 'k%d' % i) for i in xrange(200)]
+        outL = list(pysows.concurrentImap(generateMapRecord(args), iter(recL),
+                                          args.concurrency))
+        assert outL == [[str(i), 'k%d' % i, 'K%d' % i] for i in xrange(200)]
+        assert 1 < nrLookups[1] <= 16
+    finally:
+        sys.path.remove(tmpDir)
+        client = sys.modules.pop('pysows_test_lookup', None)
+        if client is not None:
+            for f in client.openedL:
+                f.close()
+        shutil.rmtree(tmpDir)
+        server.shutdown()
+        server.server_close()
+
+def generateMapBatch(mapFunc, constructor, convIdxL):
+    """
+    Generate a function that maps a batch of records column by column.
+
+    mapFunc :: *[ANY] -> [[ANY]]
+        Key columns -> mapped columns.
+    constructor :: ([tuple(str)], [[ANY]]) -> [[ANY]]
+        (records, mapped columns) -> output records.
+    convIdxL :: [(str -> ANY, int)]
+        Key columns. See pysows.getTypedColumnIndexList().
+    return :: [tuple(str)] -> [[ANY]]
+        records -> output records.
+
+    """
+    if any(idx == 0 for _, idx in convIdxL):
+        raise IOError("Column 0 cannot be used with --batch.")
+    getKeyFromRec = pysows.generateProjectConv(convIdxL)
+    getColumnL = [operator.itemgetter(idx - 1) for _, idx in convIdxL]
+    # Converters applied to a whole column. numpy parses strings in C.
+    convColumnL = []
+    for conv, _ in convIdxL:
+        if conv is pysows.identity:
+            convColumnL.append(None)
+        elif numpy is not None and conv in (int, float):
+            convColumnL.append(lambda col, conv=conv: numpy.array(col, dtype=conv))
+        else:
+            convColumnL.append(lambda col, conv=conv: map(conv, col))
+
+    def mapBatch(recL):
+        if not recL:
+            return []
+        try:
+            colL = [map(getColumn, recL) for getColumn in getColumnL]
+        except IndexError:
+            # getKeyFromRec() raises the IOError for a short record.
+            map(getKeyFromRec, recL)
+            raise
+        for i, convColumn in enumerate(convColumnL):
+            if convColumn is not None:
+                colL[i] = convColumn(colL[i])
+        outColL = []
+        for col in mapFunc(*colL):
+            if hasattr(col, 'tolist'):
+                col = col.tolist()
+            elif numpy is not None and len(col) > 0 and isinstance(col[0], numpy.generic):
+                # A list of numpy scalars like list(ys + 1) prints with numpy's repr.
+                col = numpy.asarray(col).tolist()
+            if len(col) != len(recL):
+                raise IOError("The map function returned a column of length %d"
+                              " for a batch of %d records." % (len(col), len(recL)))
+            outColL.append(col)
+        return constructor(recL, outColL)
+    return mapBatch
+
+def testGenerateMapBatch():
+    convIdxL = pysows.getTypedColumnIndexList('i1,2')
+    mapBatch = generateMapBatch(lambda xs, ys: ([x * 2 for x in xs], ys),
+                                eval(DEFAULT_BATCH_CONSTRUCTOR), convIdxL)
+    assert mapBatch([('1', 'a'), ('2', 'b')]) == [('1', 'a', 2, 'a'), ('2', 'b', 4, 'b')]
+    assert mapBatch([]) == []
+    mapBatch = generateMapBatch(lambda xs: (), eval(DEFAULT_BATCH_CONSTRUCTOR), convIdxL[:1])
+    assert mapBatch([('1', 'a'), ('2', 'b')]) == [('1', 'a'), ('2', 'b')]
+    if numpy is not None:
+        mapBatch = generateMapBatch(lambda ys: (list(ys + 0.1), ys * 2),
+                                    eval(DEFAULT_BATCH_CONSTRUCTOR),
+                                    pysows.getTypedColumnIndexList('f1'))
+        recL = mapBatch([('1.697',), ('2',)])
+        assert pysows.formatRecords(recL) == ['1.697\t1.797\t3.394', '2\t2.1\t4.0']
+    try:
+        generateMapBatch(lambda xs, ys: (xs[1:],), eval(DEFAULT_BATCH_CONSTRUCTOR),
+                         convIdxL)([('1', 'a'), ('2', 'b')])
+        assert False
+    except IOError:
+        pass
+
+def doMain():
+    args = parseOpts(sys.argv[1:])
+    if args.concurrency > 1:
+        mapRecord = generateMapRecord(args)
+        recG = pysows.recordReader(sys.stdin, args.separator)
+        with pysows.RecordWriter(sys.stdout, args.output_separator) as writer:
+            for rec in pysows.concurrentImap(mapRecord, recG, args.concurrency):
+                writer.write(rec)
+        return
+    mapLines, memo = generateMapLines(args)
 
-    for rec in reader:
-        key = getKeyFromRec(rec)
-        mapped = mapFunc(*key)
-        outRec = constructor(rec, mapped)
-        pysows.printList(outRec)
-        print
+    if args.jobs > 1:
+        for text in pysows.parallelProcessLines(mapLines, sys.stdin, args.jobs,
+                                                args.output_separator):
+            sys.stdout.write(text)
+        return
+    with pysows.RecordWriter(sys.stdout, args.output_separator) as writer:
+        lineLG = pysows.lineBatchReader(sys.stdin)
+        if args.batch > 0:
+            lineLG = pysows.rebatch(lineLG, args.batch)
+        for lineL in lineLG:
+            writer.writeBatch(mapLines(lineL))
+    if memo is not None:
+        memo.printStats()
 
 if __name__ == "__main__":
     try:
@@ -15,6 +15,8 @@ def parseOpts(args):
     parser = argparse.ArgumentParser(
         description="Project a record list as an input stream.")
     pysows.setVersion(parser)
+    pysows.setOutputSeparator(parser)
+    pysows.setJobs(parser)
     parser.add_argument("-g", "--groups", dest="group_indexes",
                         metavar='COLUMNS', default='0',
                         help="Column index list separated by comma. (default: 0)")
@@ -23,13 +25,30 @@ def parseOpts(args):
                         help="Record separator. (default spaces)")
     return parser.parse_args(args)
 
+def generateProjectLines(args):
+    """
+    args :: argparse.Namespace
+    return :: [str] -> [tuple(ANY)]
+        lines -> projected records.
+
+    """
+    project = pysows.generateProjectConv(
+        pysows.getTypedColumnIndexList(args.group_indexes))
+    separator = args.separator
+    return lambda lineL: map(project, pysows.linesToRecords(lineL, separator))
+
 def doMain():
     args = parseOpts(sys.argv[1:])
-    idxL = pysows.getTypedColumnIndexList(args.group_indexes)
+    projectLines = generateProjectLines(args)
 
-    for rec in pysows.recordReader(sys.stdin, args.separator):
-        pysows.printList(pysows.projectConv(idxL, rec))
-        print
+    if args.jobs > 1:
+        for text in pysows.parallelProcessLines(projectLines, sys.stdin, args.jobs,
+                                                args.output_separator):
+            sys.stdout.write(text)
+        return
+    with pysows.RecordWriter(sys.stdout, args.output_separator) as writer:
+        for lineL in pysows.lineBatchReader(sys.stdin):
+            writer.writeBatch(projectLines(lineL))
 
 if __name__ == "__main__":
     try:
@@ -11,6 +11,13 @@ import os
 import traceback
 import decimal
 import re
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import tempfile
+import cPickle
+import zlib
 
 VERSION_STR = '0.2'
 
@@ -82,13 +89,13 @@ def getTypedColumnIndexList(typedColumnIndexListStr):
         """
         assert(isinstance(prefix, str))
         if prefix == 'i':
-            return lambda x: int(x)
+            return int
         elif prefix == 'f' or prefix == 'n':
-            return lambda x: float(x)
+            return float
         elif prefix == 'd':
-            return lambda x: decimal.Decimal(x)
+            return decimal.Decimal
         else:
-            return lambda x : x
+            return identity
 
     re1 = re.compile(r'([find]?)([0-9]+)')
     def getConverterAndIndex(x):
@@ -109,6 +116,14 @@ def getTypedColumnIndexList(typedColumnIndexListStr):
     idxStrL = typedColumnIndexListStr.split(',')
     return map(getConverterAndIndex, idxStrL)
 
+def identity(x):
+    """
+    Converter of a column without a type prefix.
+    Projection functions skip calling this.
+
+    """
+    return x
+
 def projectConv(convIdxL, rec):
     """
     Project a record.
@@ -132,8 +147,8 @@ def projectConv(convIdxL, rec):
         elif 0 < idx and idx <= length:
             ret.append(conv(rec[idx - 1]))
         else:
-            raise IOError("Record length %d but you accesses %d.",
-                          length, idx)
+            raise IOError("Record length %d but you accesses %d."
+                          % (length, idx))
     return tuple(ret)
 
 def generateProject(idxL):
@@ -147,30 +162,53 @@ def generateProject(idxL):
 
     """
     assert(isinstance(idxL, list))
-    convIdxL = map(lambda idx: (lambda x: x, idx), idxL)
+    convIdxL = map(lambda idx: (identity, idx), idxL)
     return generateProjectConv(convIdxL)
 
 def generateProjectConv(convIdxL):
     """
     Generate a function that projects a record with type conversion.
+    The function is compiled for convIdxL so that it builds the tuple
+    by one expression and calls only converters other than identity.
 
     convIdxL :: [(str -> ANY), int]
         list of converter and column index.
         index 1 means first column.
         index 0 means all columns (converter will be ignored).
-    return :: tuple(str) -> tuple(str) throws IOError
+    return :: tuple(str) -> tuple(ANY) throws IOError
         record -> projected record.
 
     """
     assert(isinstance(convIdxL, list))
-    def project1(rec):
-        """
-        rec :: tuple(str)
-        return :: tuple(str)
-
-        """
-        return projectConv(convIdxL, rec)
-    return project1
+    namespace = {'projectConv': projectConv, 'convIdxL': convIdxL}
+    partL = []
+    itemL = []
+    for i, (conv, idx) in enumerate(convIdxL):
+        if idx == 0:
+            if itemL:
+                partL.append('(%s,)' % ', '.join(itemL))
+                itemL = []
+            partL.append('tuple(rec)')
+            continue
+        expr = 'rec[%d]' % (idx - 1)
+        if conv is not identity:
+            namespace['conv%d' % i] = conv
+            expr = 'conv%d(%s)' % (i, expr)
+        itemL.append(expr)
+    if itemL:
+        partL.append('(%s,)' % ', '.join(itemL))
+    elif not partL:
+        partL.append('()')
+
+    # projectConv() raises the IOError for a short record.
+    src = \
+        "def project(rec):\n" + \
+        "    try:\n" + \
+        "        return %s\n" % ' + '.join(partL) + \
+        "    except IndexError:\n" + \
+        "        return projectConv(convIdxL, rec)\n"
+    exec src in namespace
+    return namespace['project']
 
 def testGenerateProject():
     project = generateProject([1,2])
@@ -184,22 +222,126 @@ def testGenerateProject():
     assert project(['1']) == (1,)
     project = generateProjectConv([(float, 1), (int, 2)])
     assert project(['1.0', '2']) == (1.0, 2)
+    project = generateProjectConv([(int, 2), (identity, 0), (float, 1)])
+    assert project(('1', '2')) == (2, '1', '2', 1.0)
+    project = generateProject([])
+    assert project(('a',)) == ()
+    try:
+        generateProject([1, 3])(('a', 'b'))
+        assert False
+    except IOError:
+        pass
+
+
+# Bytes read at once by lineBatchReader().
+READ_BUFFER_SIZE = 1 << 13
+# Lines in a batch when the input is not a file.
+LINE_BATCH_SIZE = 4096
+
+def lineBatchReader(f, bufferSize=READ_BUFFER_SIZE):
+    """
+    Read lines in batches.
+    A large buffer is split into lines at once and a line
+    across buffer boundaries is carried to the next batch.
 
+    f :: file or iterable(str)
+       Input file. Other iterables of lines are grouped into batches.
+    bufferSize :: int
+       Bytes read at once.
+    return :: generator([str])
+       Batches of lines without eol.
+
+    """
+    if not hasattr(f, 'read'):
+        it = iter(f)
+        while True:
+            lines = list(itertools.islice(it, LINE_BATCH_SIZE))
+            if not lines:
+                return
+            yield [line.rstrip('\n') for line in lines]
+    try:
+        # os.read() returns available data of a pipe without waiting for a full buffer.
+        fd = f.fileno()
+        read = lambda: os.read(fd, bufferSize)
+    except (AttributeError, IOError):
+        read = lambda: f.read(bufferSize)
+    rest = ''
+    while True:
+        buf = read()
+        if not buf:
+            break
+        lines = buf.split('\n')
+        lines[0] = rest + lines[0]
+        rest = lines.pop()
+        if lines:
+            yield lines
+    if rest:
+        yield [rest]
+
+def rebatch(batchG, batchSize):
+    """
+    Regroup batches into batches of a fixed size.
+
+    batchG :: generator([ANY])
+    batchSize :: int
+    return :: generator([ANY])
+       Batches of batchSize items except the last one.
+
+    """
+    it = itertools.chain.from_iterable(batchG)
+    while True:
+        batch = list(itertools.islice(it, batchSize))
+        if not batch:
+            return
+        yield batch
+
+def testRebatch():
+    assert list(rebatch([[1, 2], [3], [4, 5, 6]], 2)) == [[1, 2], [3, 4], [5, 6]]
+    assert list(rebatch([[1, 2, 3]], 5)) == [[1, 2, 3]]
+    assert list(rebatch([], 5)) == []
+
+def recordBatchReader(f, separator=None, bufferSize=READ_BUFFER_SIZE):
+    """
+    Block-oriented version of recordReader().
+
+    f :: file or iterable(str)
+       Input file.
+    separator :: str
+       Column separator.
+    bufferSize :: int
+       Bytes read at once.
+    return :: generator([tuple(str)])
+       Batches of records.
+
+    """
+    for lines in lineBatchReader(f, bufferSize):
+        yield linesToRecords(lines, separator)
+
+def linesToRecords(lines, separator=None):
+    """
+    lines :: [str]
+    separator :: str
+       Column separator.
+    return :: [tuple(str)]
+
+    """
+    if separator is None:
+        # split() ignores trailing spaces so rstrip() is not required.
+        return map(tuple, map(str.split, lines))
+    return [tuple(line.rstrip().split(separator)) for line in lines]
 
 def recordReader(f, separator=None):
     """
     Wrapper of file object as an text input stream.
 
-    f :: file
+    f :: file or iterable(str)
        Input file.
     separator :: str
        Column separator.
-    return :: generator(tuple(str))
+    return :: iterator(tuple(str))
 
     """
-    for line in f:
-        line = line.rstrip()
-        yield tuple(line.split(separator))
+    return itertools.chain.from_iterable(recordBatchReader(f, separator))
 
 def testRecordReader():
     def dummyLines():
@@ -211,6 +353,411 @@ def testRecordReader():
         assert rec == (str(i), chr(ord('a') + i))
         i += 1
 
+def testRecordBatchReader():
+    import StringIO
+    for bufferSize in [1, 3, 100]:
+        f = StringIO.StringIO('a b\nc,d \n\ne')
+        recL = list(itertools.chain.from_iterable(recordBatchReader(f, None, bufferSize)))
+        assert recL == [('a', 'b'), ('c,d',), (), ('e',)]
+        f = StringIO.StringIO('a b\nc,d \n\ne')
+        recL = list(itertools.chain.from_iterable(recordBatchReader(f, ',', bufferSize)))
+        assert recL == [('a b',), ('c', 'd'), ('',), ('e',)]
+
+MASK64 = (1 << 64) - 1
+
+def hash64(obj):
+    """
+    Get a well-mixed 64bit hash value.
+
+    obj :: hashable
+    return :: int
+
+    """
+    # fmix64 of MurmurHash3 to scatter the builtin hash value.
+    h = hash(obj) & MASK64
+    h ^= h >> 33
+    h = (h * 0xff51afd7ed558ccd) & MASK64
+    h ^= h >> 33
+    h = (h * 0xc4ceb9fe1a85ec53) & MASK64
+    h ^= h >> 33
+    return h
+
+def stableHash64(s):
+    """
+    Get a 64bit hash value of a string which is stable among processes.
+    This can be saved to files unlike the builtin hash of a string.
+
+    s :: str
+    return :: int
+
+    """
+    # Builtin hash of an integer is stable unlike one of a string.
+    return hash64(((zlib.crc32(s) & 0xffffffff) << 32) | (zlib.adler32(s) & 0xffffffff))
+
+def generateGetRawKey(idxL, separator=None):
+    """
+    Generate a function that gets key columns from a line
+    without splitting the columns after the last key column.
+
+    idxL :: [int]
+        Key column index list. 0 means all columns.
+    separator :: str
+        Column separator.
+    return :: str -> str or None
+        line -> key columns joined by '\\0'. None if the line is too short.
+
+    """
+    if 0 in idxL:
+        project1 = generateProject(idxL)
+        def getRawKeyAll(line):
+            return '\0'.join(project1(line.rstrip().split(separator)))
+        return getRawKeyAll
+
+    maxsplit = max(idxL)
+    if len(idxL) == 1:
+        i = idxL[0] - 1
+        def getRawKey1(line):
+            cols = line.rstrip().split(separator, maxsplit)
+            if len(cols) <= i:
+                return None
+            return cols[i]
+        return getRawKey1
+
+    idxL0 = [idx - 1 for idx in idxL]
+    def getRawKey(line):
+        cols = line.rstrip().split(separator, maxsplit)
+        if len(cols) < maxsplit:
+            return None
+        return '\0'.join([cols[i] for i in idxL0])
+    return getRawKey
+
+def testGenerateGetRawKey():
+    assert generateGetRawKey([2])('a b c d\n') == 'b'
+    assert generateGetRawKey([3, 1])('a b c d\n') == 'c\0a'
+    assert generateGetRawKey([3, 1])('a b\n') is None
+    assert generateGetRawKey([2], ',')('a,b\n') == 'b'
+    assert generateGetRawKey([0])('a b\n') == 'a\0b'
+
+class LruMemo(object):
+    """
+    Memoized function with a bounded LRU cache of its results.
+    Entries are [prev, next, args, result] links of a circular list
+    whose head is the least recently used one.
+
+    """
+    def __init__(self, func, size):
+        """
+        func :: ANY -> ANY
+        size :: int
+            Maximum number of cached results.
+
+        """
+        assert size > 0
+        self.func = func
+        self.size = size
+        self.cache = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.nrHits = 0
+        self.nrMisses = 0
+
+    def __call__(self, *args):
+        """
+        args :: hashable
+            Arguments of func.
+        return :: ANY
+
+        """
+        root = self.root
+        link = self.cache.get(args)
+        if link is not None:
+            prev, next, _, result = link
+            prev[1] = next
+            next[0] = prev
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            self.nrHits += 1
+            return result
+
+        result = self.func(*args)
+        self.nrMisses += 1
+        if len(self.cache) < self.size:
+            last = root[0]
+            last[1] = root[0] = self.cache[args] = [last, root, args, result]
+            return result
+        # Reuse the old root as the new entry and the oldest entry as the root.
+        oldRoot = root
+        oldRoot[2] = args
+        oldRoot[3] = result
+        self.root = root = oldRoot[1]
+        del self.cache[root[2]]
+        root[2] = root[3] = None
+        self.cache[args] = oldRoot
+        return result
+
+    def printStats(self, f=sys.stderr):
+        """
+        Print the hit rate.
+
+        f :: file
+            Output stream.
+
+        """
+        nrCalls = self.nrHits + self.nrMisses
+        print >>f, "memo: calls: %d hits: %d misses: %d hit rate: %.1f%%" \
+            % (nrCalls, self.nrHits, self.nrMisses,
+               100.0 * self.nrHits / max(1, nrCalls))
+
+def testLruMemo():
+    calls = []
+    def square(x):
+        calls.append(x)
+        return x * x
+    memo = LruMemo(square, 2)
+    assert [memo(x) for x in [1, 2, 1, 3, 1, 2]] == [1, 4, 1, 9, 1, 4]
+    assert calls == [1, 2, 3, 2]
+    assert (memo.nrHits, memo.nrMisses) == (2, 4)
+    assert sorted(memo.cache) == [(1,), (2,)]
+    memo = LruMemo(lambda x, y: x + y, 100)
+    for i in xrange(1000):
+        assert memo(i % 150, 1) == i % 150 + 1
+    assert len(memo.cache) == 100
+
+# Bytes of lines given to a parallel worker at once.
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+
+def lineChunkGenerator(lineLG, chunkSize=PARALLEL_CHUNK_SIZE):
+    """
+    Group batches of lines into chunks.
+
+    lineLG :: generator([str])
+        Batches of lines like lineBatchReader().
+    chunkSize :: int
+        Approximate chunk size in bytes.
+    return :: generator([str])
+
+    """
+    chunk = []
+    size = 0
+    for lines in lineLG:
+        chunk += lines
+        size += sum(map(len, lines))
+        if size >= chunkSize:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+def parallelImap(func, argG, nrWorkers, initializer=None, initargs=()):
+    """
+    Apply a function in a process pool keeping the input order.
+    Only a bounded number of tasks are in flight,
+    so argG is consumed as results are taken.
+
+    func :: a -> b
+        Module-level function which can be pickled.
+    argG :: generator(a)
+    nrWorkers :: int
+        Number of worker processes.
+    initializer :: (*initargs) -> None
+        Called once in each worker process.
+    initargs :: tuple
+    return :: generator(b)
+
+    """
+    pool = multiprocessing.Pool(nrWorkers, initializer, initargs)
+    return boundedImap(pool, func, argG, 2 * nrWorkers)
+
+def concurrentImap(func, argG, concurrency):
+    """
+    Apply a function in a thread pool keeping the input order.
+    This is for functions which wait for I/O such as a local service,
+    so func need not be picklable and shares the memory of the caller.
+
+    func :: a -> b
+    argG :: generator(a)
+    concurrency :: int
+        Number of threads, that is calls in progress at once.
+    return :: generator(b)
+
+    """
+    pool = multiprocessing.pool.ThreadPool(concurrency)
+    return boundedImap(pool, func, argG, 2 * concurrency)
+
+def boundedImap(pool, func, argG, maxPending):
+    """
+    Apply a function in a pool keeping the input order.
+    The pool is terminated at the end.
+
+    pool :: multiprocessing.pool.Pool
+    func :: a -> b
+    argG :: generator(a)
+    maxPending :: int
+        Maximum number of tasks in flight, which bounds the reorder buffer.
+    return :: generator(b)
+
+    """
+    try:
+        pending = collections.deque()
+        for arg in argG:
+            pending.append(pool.apply_async(func, (arg,)))
+            if len(pending) >= maxPending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def testConcurrentImap():
+    import time
+    import random
+    import threading
+    lock = threading.Lock()
+    nrCalls = [0, 0] # calls in progress and its peak.
+    def slowSquare(x):
+        with lock:
+            nrCalls[0] += 1
+            nrCalls[1] = max(nrCalls)
+        time.sleep(random.random() * 0.02)
+        with lock:
+            nrCalls[0] -= 1
+        return x * x
+    assert list(concurrentImap(slowSquare, iter(xrange(200)), 20)) \
+        == [x * x for x in xrange(200)]
+    assert 1 < nrCalls[1] <= 20
+
+def setJobs(parser):
+    """
+    parser :: argparser.Parser
+
+    """
+    parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', type=int, default=1,
+                        help='Number of worker processes. Chunks of input are processed' +
+                        ' in parallel and output in the input order. (default: 1)')
+
+# Chunk processor and output separator of a worker of parallelProcessLines().
+lineWorkerState = None
+
+def initLineWorker(processor, outputSeparator):
+    global lineWorkerState
+    lineWorkerState = (processor, outputSeparator)
+
+def processLineChunk(lineL):
+    """
+    lineL :: [str]
+    return :: str
+        Formatted output records.
+
+    """
+    processor, outputSeparator = lineWorkerState
+    lineL = formatRecords(processor(lineL), outputSeparator)
+    if not lineL:
+        return ''
+    lineL.append('')
+    return '\n'.join(lineL)
+
+def parallelProcessLines(processor, f, nrWorkers, outputSeparator='\t',
+                         chunkSize=PARALLEL_CHUNK_SIZE):
+    """
+    Engine of stateless tools with --jobs.
+    Chunks of lines are processed in a process pool and the output of
+    each chunk is formatted in the worker. Only 2 * nrWorkers chunks are
+    in flight, which bounds the reorder buffer.
+
+    processor :: [str] -> [[ANY]]
+        Compiled processor of a chunk of lines without eol to output records.
+        Workers are forked so it need not be picklable.
+    f :: file or iterable(str)
+        Input.
+    nrWorkers :: int
+    outputSeparator :: str
+    chunkSize :: int
+        Approximate bytes of a chunk.
+    return :: generator(str)
+        Formatted output of chunks in the input order.
+
+    """
+    chunkG = lineChunkGenerator(lineBatchReader(f), chunkSize)
+    return parallelImap(processLineChunk, chunkG, nrWorkers,
+                        initLineWorker, (processor, outputSeparator))
+
+def testParallelProcessLines():
+    import StringIO
+    f = StringIO.StringIO(''.join('%d x\n' % i for i in xrange(1000)))
+    processor = lambda lineL: [(y, x) for x, y in linesToRecords(lineL) if int(x) % 2 == 0]
+    textL = parallelProcessLines(processor, f, 2, ',', 100)
+    assert ''.join(textL) == ''.join('x,%d\n' % i for i in xrange(0, 1000, 2))
+
+class SpillFile(object):
+    """
+    Temporary file of picklable items.
+    Items are appended and then read once in the same order.
+    They are pickled in blocks to reduce overhead.
+
+    """
+    BLOCK_SIZE = 1024
+
+    def __init__(self, tmpDir=None, prefix='pysows-'):
+        """
+        tmpDir :: str
+            Directory for the temporary file. None means the system default.
+        prefix :: str
+            Prefix of the temporary file name.
+
+        """
+        self.f = tempfile.TemporaryFile(prefix=prefix, dir=tmpDir)
+        self.block = []
+
+    def append(self, item):
+        """
+        item :: ANY - picklable.
+
+        """
+        self.block.append(item)
+        if len(self.block) >= SpillFile.BLOCK_SIZE:
+            self._flush()
+
+    def extend(self, itemG):
+        """
+        itemG :: generator(ANY)
+
+        """
+        for item in itemG:
+            self.append(item)
+
+    def _flush(self):
+        if self.block:
+            cPickle.dump(self.block, self.f, cPickle.HIGHEST_PROTOCOL)
+            self.block = []
+
+    def __iter__(self):
+        """
+        Read all the items. The file is closed after that.
+
+        return :: generator(ANY)
+
+        """
+        self._flush()
+        self.f.seek(0)
+        try:
+            while True:
+                for item in cPickle.load(self.f):
+                    yield item
+        except EOFError:
+            pass
+        self.f.close()
+
+def testSpillFile():
+    f = SpillFile()
+    f.extend(xrange(3000))
+    f.append('a')
+    assert list(f) == range(3000) + ['a']
+
 def printList(anyList, f=sys.stdout, sep='\t'):
     """
     Print list of printable objects.
@@ -231,6 +778,107 @@ def printList(anyList, f=sys.stdout, sep='\t'):
             print >>f, item,
             isNotFirst = True
 
+# Bytes buffered by RecordWriter before writing.
+WRITE_BUFFER_SIZE = 1 << 16
+
+def setOutputSeparator(parser):
+    """
+    parser :: argparser.Parser
+
+    """
+    parser.add_argument('--output-separator', metavar='SEP', dest='output_separator',
+                        default='\t', help='Output column separator. (default: tab)')
+
+def formatRecords(recL, separator='\t'):
+    """
+    recL :: [[ANY]]
+        Columns must be printable.
+    separator :: str
+    return :: [str]
+        Lines without eol.
+
+    """
+    try:
+        return [separator.join(rec) for rec in recL]
+    except TypeError:
+        return [separator.join(map(str, rec)) for rec in recL]
+
+class RecordWriter(object):
+    """
+    Buffered writer of records.
+    Records are formatted by a single join per record instead of
+    print statements per column, and written per large buffer.
+    Columns which are not strings are formatted by str() like print.
+
+    Use this with 'with' statement to flush the rest at the end.
+
+    """
+    def __init__(self, f=None, separator='\t', bufferSize=WRITE_BUFFER_SIZE):
+        """
+        f :: file
+            Output stream. (default: sys.stdout)
+        separator :: str
+            Column separator.
+        bufferSize :: int
+            Bytes buffered before writing.
+
+        """
+        self.f = sys.stdout if f is None else f
+        self.separator = separator
+        self.bufferSize = bufferSize
+        self.lineL = []
+        self.size = 0
+
+    def write(self, rec):
+        """
+        rec :: [ANY]
+            Columns must be printable.
+
+        """
+        try:
+            line = self.separator.join(rec)
+        except TypeError:
+            line = self.separator.join(map(str, rec))
+        self.lineL.append(line)
+        self.size += len(line)
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def writeBatch(self, recL):
+        """
+        recL :: [[ANY]]
+
+        """
+        lineL = formatRecords(recL, self.separator)
+        self.lineL += lineL
+        self.size += sum(map(len, lineL))
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if self.lineL:
+            self.lineL.append('')
+            self.f.write('\n'.join(self.lineL))
+            self.lineL = []
+            self.size = 0
+        self.f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.flush()
+
+def testRecordWriter():
+    import StringIO
+    f = StringIO.StringIO()
+    with RecordWriter(f, '\t', 4) as writer:
+        writer.write(('a', 'b'))
+        writer.write(('c', 1, 2.5, None))
+        writer.writeBatch([('d',), ()])
+        writer.writeBatch([(1,), ('e', 'f')])
+    assert f.getvalue() == 'a\tb\nc\t1\t2.5\tNone\nd\n\n1\ne\tf\n'
+
 def exitWithError(e):
     """
     e :: Exception
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Bounded-memory sketches for approximate aggregation.
+
+"""
+
+import sys
+import math
+import struct
+import zlib
+from pysows import hash64, MASK64
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog distinct counter.
+    Hash values are kept exactly while they are few (sparse mode),
+    then 2^p one-byte registers are used (dense mode).
+
+    """
+    def __init__(self, p=10):
+        """
+        p :: int
+            Precision. Standard error is about 1.04 / sqrt(2^p).
+
+        """
+        assert(4 <= p and p <= 16)
+        self.p = p
+        self.m = 1 << p
+        self.sparseLimit = self.m // 16
+        self.sparse = set()
+        self.registers = None
+
+    def add(self, obj):
+        """
+        obj :: hashable
+
+        """
+        h = hash64(obj)
+        if self.registers is None:
+            self.sparse.add(h)
+            if len(self.sparse) > self.sparseLimit:
+                self._toDense()
+        else:
+            self._addHash(h)
+
+    def _addHash(self, h):
+        idx = h >> (64 - self.p)
+        w = (h << self.p) & MASK64
+        rank = 1
+        if w == 0:
+            rank = 64 - self.p + 1
+        else:
+            while not (w & (1 << 63)):
+                rank += 1
+                w <<= 1
+        if self.registers[idx] < rank:
+            self.registers[idx] = rank
+
+    def _toDense(self):
+        self.registers = bytearray(self.m)
+        for h in self.sparse:
+            self._addHash(h)
+        self.sparse = None
+
+    def merge(self, rhs):
+        """
+        Merge another HyperLogLog with the same precision.
+
+        rhs :: HyperLogLog
+
+        """
+        assert(self.p == rhs.p)
+        if rhs.registers is None:
+            for h in rhs.sparse:
+                if self.registers is None:
+                    self.sparse.add(h)
+                else:
+                    self._addHash(h)
+            if self.registers is None and len(self.sparse) > self.sparseLimit:
+                self._toDense()
+            return
+        if self.registers is None:
+            self._toDense()
+        regs = self.registers
+        for i, r in enumerate(rhs.registers):
+            if regs[i] < r:
+                regs[i] = r
+
+    def memoryBytes(self):
+        """
+        return :: int
+            Rough memory size of the state.
+
+        """
+        if self.registers is None:
+            # A hash value and its slot in the set.
+            return sys.getsizeof(self.sparse) + 32 * len(self.sparse)
+        return sys.getsizeof(self.registers)
+
+    def count(self):
+        """
+        return :: int
+            Estimated number of distinct objects.
+
+        """
+        if self.registers is None:
+            return len(self.sparse)
+        m = self.m
+        alpha = 0.7213 / (1.0 + 1.079 / m)
+        est = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count('\x00')
+        if est <= 2.5 * m and zeros > 0:
+            est = m * math.log(float(m) / zeros)
+        return int(round(est))
+
+
+def testHyperLogLog():
+    hll = HyperLogLog()
+    for i in xrange(50):
+        hll.add(str(i))
+        hll.add(str(i))
+    assert hll.count() == 50
+    for i in xrange(100000):
+        hll.add(str(i))
+    assert abs(hll.count() - 100000) < 100000 * 0.1
+    hll2 = HyperLogLog()
+    for i in xrange(50000, 150000):
+        hll2.add(str(i))
+    hll.merge(hll2)
+    assert abs(hll.count() - 150000) < 150000 * 0.1
+    assert HyperLogLog().memoryBytes() < hll2.memoryBytes() < 2 * hll2.m
+
+
+class KllSketch(object):
+    """
+    KLL quantile sketch.
+    Items are kept in compactors whose capacities decrease geometrically
+    with depth, so memory is bounded by about 3k items.
+    Compaction alternates the kept half instead of using random bits
+    so results are deterministic.
+
+    """
+    def __init__(self, k=200):
+        """
+        k :: int
+            Accuracy parameter. Rank error is about 1.7 / k.
+
+        """
+        self.k = k
+        self.compactors = []
+        self.size = 0
+        self.maxSize = 0
+        self.offset = 0
+        self._grow()
+
+    def _grow(self):
+        self.compactors.append([])
+        self.maxSize = sum(self._capacity(h) for h in xrange(len(self.compactors)))
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil((2.0 / 3.0) ** depth * self.k)) + 1
+
+    def add(self, item):
+        """
+        item :: ANY - comparable.
+
+        """
+        self.compactors[0].append(item)
+        self.size += 1
+        if self.size >= self.maxSize:
+            self._compress()
+
+    def _compress(self):
+        while self.size >= self.maxSize:
+            for h, c in enumerate(self.compactors):
+                if len(c) >= self._capacity(h):
+                    break
+            else:
+                return
+            if h + 1 >= len(self.compactors):
+                self._grow()
+            c.sort()
+            # Keep the last item of an odd-length compactor in place.
+            rest = c[len(c) - len(c) % 2:]
+            self.compactors[h + 1].extend(c[self.offset:len(c) - len(rest):2])
+            self.compactors[h] = rest
+            self.offset ^= 1
+            self.size = sum(len(x) for x in self.compactors)
+
+    def merge(self, rhs):
+        """
+        Merge another KllSketch.
+
+        rhs :: KllSketch
+
+        """
+        while len(self.compactors) < len(rhs.compactors):
+            self._grow()
+        for h, c in enumerate(rhs.compactors):
+            self.compactors[h].extend(c)
+        self.size = sum(len(x) for x in self.compactors)
+        self._compress()
+
+    def memoryBytes(self):
+        """
+        return :: int
+            Rough memory size of the state.
+            Items are assumed to have the size of one of them.
+
+        """
+        itemSize = 0
+        for c in self.compactors:
+            if c:
+                itemSize = sys.getsizeof(c[0])
+                break
+        return sum(map(sys.getsizeof, self.compactors)) + itemSize * self.size
+
+    def quantile(self, q):
+        """
+        q :: float - in [0, 1].
+        return :: ANY or None
+            Smallest item whose estimated rank is at least q.
+
+        """
+        weighted = []
+        for h, c in enumerate(self.compactors):
+            weighted += [(item, 1 << h) for item in c]
+        if not weighted:
+            return None
+        weighted.sort(key=lambda x: x[0])
+        total = sum(w for _, w in weighted)
+        target = q * total
+        cum = 0
+        for item, w in weighted:
+            cum += w
+            if cum >= target:
+                return item
+        return weighted[-1][0]
+
+
+def testKllSketch():
+    kll = KllSketch()
+    for i in xrange(100):
+        kll.add(i)
+    assert kll.quantile(0.5) == 49
+    assert kll.quantile(1.0) == 99
+    kll = KllSketch()
+    for i in xrange(100000):
+        kll.add((i * 7919) % 100000)
+    assert sum(len(c) for c in kll.compactors) < 3 * kll.k + 100
+    assert abs(kll.quantile(0.99) - 99000) < 2000
+    kll2 = KllSketch()
+    for i in xrange(100000, 200000):
+        kll2.add(i)
+    kll.merge(kll2)
+    assert abs(kll.quantile(0.5) - 100000) < 4000
+    assert KllSketch().memoryBytes() < 100 < kll.memoryBytes() < 3 * kll.k * 40
+
+
+class BloomFilter(object):
+    """
+    Bloom filter of strings.
+    CRC32 and Adler32 are used as hash functions because they are cheap
+    and stable among processes so that a filter can be saved and loaded.
+
+    """
+    MAGIC = 'PYSOWSBF'
+    HEADER = struct.Struct('<8sQI')
+
+    def __init__(self, nrBits, nrHashes):
+        """
+        nrBits :: int
+        nrHashes :: int
+
+        """
+        self.nrBits = max(64, nrBits)
+        self.nrHashes = nrHashes
+        self.hashRange = range(nrHashes)
+        self.bits = bytearray((self.nrBits + 7) // 8)
+
+    @classmethod
+    def create(cls, nrItems, bitsPerItem=10, nrHashes=4):
+        """
+        nrItems :: int
+            Expected number of items.
+        bitsPerItem :: int
+        nrHashes :: int
+            Fewer hashes than optimal keep probing cheap.
+            10 bits and 4 hashes make false positive rate about 1.2%.
+        return :: BloomFilter
+
+        """
+        return cls(nrItems * bitsPerItem, nrHashes)
+
+    def add(self, s):
+        """
+        s :: str
+
+        """
+        h1 = zlib.crc32(s) & 0xffffffff
+        h2 = zlib.adler32(s) | 1
+        for i in xrange(self.nrHashes):
+            pos = (h1 + i * h2) % self.nrBits
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def mayContain(self, s):
+        """
+        s :: str or None
+        return :: bool
+            False if s has not been added. None is always True.
+
+        """
+        if s is None:
+            return True
+        # Double hashing. CRC32 is the base and Adler32 is the stride.
+        pos = zlib.crc32(s) & 0xffffffff
+        h2 = zlib.adler32(s) | 1
+        bits = self.bits
+        nrBits = self.nrBits
+        for _ in self.hashRange:
+            pos %= nrBits
+            if not (bits[pos >> 3] & (1 << (pos & 7))):
+                return False
+            pos += h2
+        return True
+
+    def filterLines(self, lineG, getRawKey):
+        """
+        Filter lines by their raw key.
+
+        lineG :: generator(str)
+        getRawKey :: str -> str or None
+            See pysows.generateGetRawKey().
+        return :: generator(str)
+            Lines whose key may have been added.
+
+        """
+        mayContain = self.mayContain
+        for line in lineG:
+            if mayContain(getRawKey(line)):
+                yield line
+
+    def save(self, f):
+        """
+        f :: file
+
+        """
+        f.write(self.HEADER.pack(self.MAGIC, self.nrBits, self.nrHashes))
+        f.write(self.bits)
+
+    @classmethod
+    def load(cls, f):
+        """
+        f :: file
+        return :: BloomFilter
+
+        """
+        header = f.read(cls.HEADER.size)
+        if len(header) != cls.HEADER.size:
+            raise IOError("Not a Bloom filter file.")
+        magic, nrBits, nrHashes = cls.HEADER.unpack(header)
+        if magic != cls.MAGIC:
+            raise IOError("Not a Bloom filter file.")
+        bloom = cls(nrBits, nrHashes)
+        bits = f.read()
+        if len(bits) != len(bloom.bits):
+            raise IOError("Broken Bloom filter file.")
+        bloom.bits = bytearray(bits)
+        return bloom
+
+
+def testBloomFilter():
+    import StringIO
+    bloom = BloomFilter.create(1000)
+    for i in xrange(1000):
+        bloom.add(str(i))
+    assert all(bloom.mayContain(str(i)) for i in xrange(1000))
+    nrFalse = sum(bloom.mayContain(str(i)) for i in xrange(1000, 11000))
+    assert nrFalse < 300
+    f = StringIO.StringIO()
+    bloom.save(f)
+    bloom2 = BloomFilter.load(StringIO.StringIO(f.getvalue()))
+    assert bloom2.bits == bloom.bits and bloom2.nrHashes == bloom.nrHashes
@@ -8,7 +8,32 @@ Sort a list of record as an input stream.
 
 import sys
 import argparse
+import re
+import decimal
+import heapq
+import itertools
+import os
+import shutil
+import tempfile
+import cPickle
 import pysows
+import util
+
+# Rough memory cost of the (key, line) tuple of an entry and its slot in a run.
+ENTRY_OVERHEAD = 80
+
+# Maximum number of runs merged at once.
+MERGE_FANIN = 64
+
+DEFAULT_KEY_FUNC = "lambda *xs: xs"
+
+# Number of (key, line) pairs in a block of a run file of parallel sort.
+# The first key of each block is a sample of the run and indexes the file.
+RUN_BLOCK_SIZE = 1024
+
+# Number of key ranges per parallel sort worker.
+# More ranges than workers balance the load of the merge phase.
+RANGES_PER_WORKER = 4
 
 def parseOpts(args):
     """
@@ -22,13 +47,16 @@ def parseOpts(args):
     pysows.setVersion(parser)
     parser.add_argument("-g", "--groups", dest="group_indexes",
                         metavar='COLUMNS', default='0',
-                        help=pysows.GROUPS_HELP_MESSAGE)
+                        help=pysows.GROUPS_HELP_MESSAGE +
+                        " You can add a suffix ':asc' or ':desc' to each index" +
+                        " except 0 like 'n2:desc,1:asc'.")
     parser.add_argument("-k", "--keyfunc", dest="key_func",
-                        metavar='FUNCTION', default="lambda *xs: xs",
-                        help="Key function. (default: 'lambda *args: args')")
+                        metavar='FUNCTION', default=DEFAULT_KEY_FUNC,
+                        help="Key function. (default: '%s')" % DEFAULT_KEY_FUNC)
     parser.add_argument("-c", "--cmpfunc", dest="cmp_func",
                         metavar='FUNCTION', default=None,
-                        help="(Not supported yet) Compare function. -c is prior to -k option.")
+                        help="Compare function of two projected records" +
+                        " like cmp(). -c is prior to -k option.")
     parser.add_argument("-r", "--reverse", action="store_true", dest="reverse",
                         default=False,
                         help="Reverse the result of comprations.")
@@ -37,64 +65,209 @@ def parseOpts(args):
     parser.add_argument("-s", "--separator", dest="separator",
                         metavar='SEP', default=None,
                         help="Column separator. (default: spaces)")
+    parser.add_argument("-S", "--buffer-size", dest="buffer_size",
+                        metavar='SIZE', default=None,
+                        help="Memory budget like '512M' or '2G'." +
+                        " Sorted runs are spilled to temporary files and merged" +
+                        " when the input exceeds it. (default: unlimited)")
+    parser.add_argument("-T", "--temporary-directory", dest="tmp_dir",
+                        metavar='DIR', default=None,
+                        help="Directory for temporary files. (default: system default)")
+    parser.add_argument("-j", "--parallel", dest="parallel", type=int,
+                        metavar='N', default=1,
+                        help="Number of worker processes that extract keys," +
+                        " sort chunks and merge key ranges. (default: 1)")
+    parser.add_argument("-n", "--limit", dest="limit", type=int,
+                        metavar='K', default=None,
+                        help="Output only the first K lines of the sorted result" +
+                        " using O(K) memory. (default: unlimited)")
     return  parser.parse_args(args)
 
-def sortKeyAndLineGenerator(convIdxL, keyFunc, lineG, separator=None):
+def parseSortSpec(sortSpecStr):
     """
-    Make a (key, line) generator from a line generator.
+    Parse a sort column specification.
 
-    convIdxL :: [(str -> ANY, int)]
-        Index list.
-        1st: converter from string to some type which is comparable.
-        2nd: item index.
-    keyFunc :: *tuple(ANY) -> ANY
-        Key generator. ANY type must be comparable.
-    lineG :: generator(str)
-        Line generator. (file object etc)
-    separator :: str
-        Column separator.
+    sortSpecStr :: str
+        Typed column index list like "n2:desc,1:asc".
+        Each index may have a direction suffix ':asc' or ':desc'.
+    return :: [(str, int, bool)]
+        1st: type prefix ('', 'i', 'f', 'n' or 'd').
+        2nd: column index. 0 means all columns.
+        3rd: True if descending.
 
-    return :: generator((ANY, str))
-        1st: sort key which must be comparable.
-        2nd: line without eol.
+    """
+    re1 = re.compile(r'([find]?)([0-9]+)(?::(asc|desc))?$')
+    def parse1(x):
+        m = re1.match(x)
+        if m is None:
+            raise IOError("%s is wrong as an index." % x)
+        isDesc = m.group(3) == 'desc'
+        idx = int(m.group(2))
+        if idx == 0 and isDesc:
+            raise IOError("%s: all columns cannot be descending." % x)
+        return (m.group(1), idx, isDesc)
+    return map(parse1, sortSpecStr.split(','))
+
+def testParseSortSpec():
+    assert parseSortSpec('1,n2') == [('', 1, False), ('n', 2, False)]
+    assert parseSortSpec('n2:desc,1:asc') == [('n', 2, True), ('', 1, False)]
+
+# Translation table that inverts the order of bytes.
+INVERT_TABLE = ''.join(chr(255 - i) for i in xrange(256))
+
+CONVERTER_NAME_DICT = {'': None, 'i': 'int', 'f': 'float', 'n': 'float', 'd': 'Decimal'}
+
+def raiseIndexError(idxL, rec):
+    """
+    idxL :: [int]
+    rec :: [str]
+    throws IOError
+
+    """
+    length = len(rec)
+    for idx in idxL:
+        if idx > length:
+            raise IOError("Index outbound error %d [1,%d]" % (idx, length))
+    raise IOError("Index outbound error [1,%d]" % length)
+
+class CmpKey(object):
+    """
+    Sort key adapter of a comparison function like functools.cmp_to_key().
+    The projected key is computed once per line and cached in the adapter,
+    so each comparison costs one call of the comparison function.
+
+    """
+    __slots__ = ('key',)
+    cmpFunc = None
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, rhs):
+        return CmpKey.cmpFunc(self.key, rhs.key) < 0
+
+    def __eq__(self, rhs):
+        return CmpKey.cmpFunc(self.key, rhs.key) == 0
 
+def compileLineKey(sortSpecL, separator=None, keyFunc=None, cmpFunc=None):
     """
-    def getKey(rec):
-        """
-        rec :: tuple(str)
-        return :: tuple(ANY)
+    Compile a function that gets a sort key from a line.
+    The column projection, type conversion, direction and key function
+    are fused into one generated function.
 
-        """
-        length = len(rec)
-        ret = []
-        for converter, idx in convIdxL:
-            if idx == 0:
-                ret += map(converter, list(rec))
-            elif 0 < idx and idx <= length:
-                ret.append(converter(rec[idx - 1]))
+    sortSpecL :: [(str, int, bool)]
+        Result of parseSortSpec().
+    separator :: str
+        Column separator.
+    keyFunc :: *tuple(ANY) -> ANY
+        Key function applied to the projected columns. None means identity.
+    cmpFunc :: (tuple(ANY), tuple(ANY)) -> int
+        Comparison function of projected columns. This is prior to keyFunc.
+    return :: str -> ANY
+        line without eol -> sort key.
+
+    """
+    partL = []
+    itemL = []
+    for prefix, idx, isDesc in sortSpecL:
+        conv = CONVERTER_NAME_DICT[prefix]
+        if idx == 0:
+            if itemL:
+                partL.append('(%s,)' % ', '.join(itemL))
+                itemL = []
+            if conv is None:
+                partL.append('tuple(rec)')
             else:
-                raise IOError("Index outbound error %d [1,%d]" % (idx, length))
-        return tuple(ret)
+                partL.append('tuple(map(%s, rec))' % conv)
+            continue
+        expr = 'rec[%d]' % (idx - 1)
+        if conv is not None:
+            expr = '%s(%s)' % (conv, expr)
+            if isDesc:
+                expr = '-' + expr
+        elif isDesc:
+            # '\x00' and '\x01' are escaped as '\x01\x01' and '\x01\x02' keeping the order,
+            # so '\xff' is the only one after inversion and it terminates the string
+            # to put longer ones first.
+            expr = ("%s.replace('\\x01', '\\x01\\x02').replace('\\x00', '\\x01\\x01')"
+                    ".translate(INVERT_TABLE) + '\\xff'") % expr
+        itemL.append(expr)
+    if itemL or not partL:
+        partL.append('(%s,)' % ', '.join(itemL))
+    keyExpr = ' + '.join(partL)
 
-    def getSortKeyAndLine(keyFunc, line):
-        """
-        keyFunc :: *tuple(ANY) -> tuple(ANY)
-        line :: str
-            input string line with eol.
+    if cmpFunc is not None:
+        CmpKey.cmpFunc = staticmethod(cmpFunc)
+        keyExpr = 'CmpKey(%s)' % keyExpr
+    elif keyFunc is not None:
+        if len(partL) == 1 and itemL:
+            keyExpr = 'keyFunc(%s)' % ', '.join(itemL)
+        else:
+            keyExpr = 'keyFunc(*(%s))' % keyExpr
 
-        return :: (ANY, str)
-            1st: key for sort which must be comparable.
-            2nd: line string without eol.
+    idxL = [idx for _, idx, _ in sortSpecL]
+    maxIdx = max([0] + idxL)
+    src = \
+        "def getLineKey(line):\n" + \
+        "    rec = line.split(separator)\n"
+    if maxIdx > 0:
+        # Only the column access is checked. keyFunc may raise IndexError itself.
+        src += \
+            "    if len(rec) < %d:\n" % maxIdx + \
+            "        raiseIndexError(idxL, rec)\n"
+    src += "    return %s\n" % keyExpr
+    namespace = {
+        'separator': separator, 'keyFunc': keyFunc, 'CmpKey': CmpKey,
+        'Decimal': decimal.Decimal, 'INVERT_TABLE': INVERT_TABLE,
+        'raiseIndexError': raiseIndexError, 'idxL': idxL,
+    }
+    exec src in namespace
+    return namespace['getLineKey']
 
-        """
-        line = line.rstrip()
-        rec = line.split(separator)
-        key = getKey(rec)
-        sortKey = keyFunc(*key)
-        return sortKey, line
+def testCompileLineKey():
+    getKey = compileLineKey(parseSortSpec('n2:desc,1'))
+    assert getKey('a 2') == (-2.0, 'a')
+    getKey = compileLineKey(parseSortSpec('1:desc'))
+    assert sorted(['ab', 'abc', 'b'], key=getKey) == ['b', 'abc', 'ab']
+    lineL = [''.join(x) for n in xrange(4)
+             for x in itertools.product('\x00\x01\x02\xff', repeat=n)]
+    getKey = compileLineKey(parseSortSpec('1:desc'), separator=',')
+    assert sorted(lineL, key=getKey) == sorted(lineL, reverse=True)
+    getKey = compileLineKey(parseSortSpec('1:desc,2'), separator=',')
+    assert sorted((x + ',' + y for x in lineL[:21] for y in 'ba'), key=getKey) \
+        == [x + ',' + y for x in sorted(lineL[:21], reverse=True) for y in 'ab']
+    getKey = compileLineKey(parseSortSpec('i2,0'), keyFunc=lambda *xs: xs[0])
+    assert getKey('a 3') == 3
+    getKey = compileLineKey(parseSortSpec('i1'), cmpFunc=lambda x, y: cmp(y, x))
+    assert sorted(['1', '3', '2'], key=getKey) == ['3', '2', '1']
+    try:
+        compileLineKey(parseSortSpec('3'))('a b')
+        assert False
+    except IOError:
+        pass
+    try:
+        compileLineKey(parseSortSpec('1'), keyFunc=lambda x: x[5])('a b')
+        assert False
+    except IndexError:
+        pass
+
+def sortKeyAndLineGenerator(getLineKey, lineG):
+    """
+    Make a (key, line) generator from a line generator.
 
+    getLineKey :: str -> ANY
+        Sort key of a line without eol. See compileLineKey().
+    lineG :: generator(str)
+        Line generator. (file object etc)
+
+    return :: generator((ANY, str))
+        1st: sort key which must be comparable.
+        2nd: line without eol.
+
+    """
     for line in lineG:
-        yield getSortKeyAndLine(keyFunc, line)
+        line = line.rstrip()
+        yield getLineKey(line), line
 
 def generateKeyFunc(keyFuncStr, globalNamespace, localNamespace):
     """
@@ -110,19 +283,573 @@ def generateKeyFunc(keyFuncStr, globalNamespace, localNamespace):
     else:
         return lambda *xs: xs
 
-def doMain():
-    args = parseOpts(sys.argv[1:])
+class ReverseKey(object):
+    """
+    Key wrapper that inverts the order of comparison.
+
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, rhs):
+        return rhs.key < self.key
+
+    def __eq__(self, rhs):
+        return self.key == rhs.key
+
+def writeRun(sortKeyAndLineG, tmpDir=None):
+    """
+    Write sorted (key, line) pairs to a temporary file.
+
+    sortKeyAndLineG :: generator((ANY, str))
+    tmpDir :: str
+        Directory for the temporary file.
+    return :: pysows.SpillFile
+
+    """
+    f = pysows.SpillFile(tmpDir, 'pysows-sort-')
+    f.extend(sortKeyAndLineG)
+    return f
+
+def mergeRuns(runL, reverse=False):
+    """
+    Merge sorted runs of (key, line) pairs.
+    Pairs with the same key keep the order of runL so the merge is stable.
+
+    runL :: [iter((ANY, str))]
+        Each run must be sorted with the same reverse flag.
+    reverse :: bool
+    return :: generator((ANY, str))
+
+    """
+    if reverse:
+        wrap = ReverseKey
+    else:
+        wrap = lambda x: x
+    heap = []
+    for i, run in enumerate(runL):
+        run = iter(run)
+        for key, line in run:
+            heap.append((wrap(key), i, key, line, run))
+            break
+    heapq.heapify(heap)
+    while heap:
+        _, i, key, line, run = heap[0]
+        yield key, line
+        for key, line in run:
+            heapq.heapreplace(heap, (wrap(key), i, key, line, run))
+            break
+        else:
+            heapq.heappop(heap)
 
-    convIdxL = pysows.getTypedColumnIndexList(args.group_indexes)
+def getKeySize(key):
+    """
+    Rough memory size of a sort key and the columns in it.
+
+    key :: ANY
+    return :: int
+
+    """
+    getsizeof = sys.getsizeof
+    if type(key) is tuple:
+        return getsizeof(key) + sum(map(getsizeof, key))
+    if isinstance(key, CmpKey):
+        return getsizeof(key) + getKeySize(key.key)
+    return getsizeof(key)
+
+def sortedRuns(reader, bufferSize, reverse=False, spill=False, tmpDir=None):
+    """
+    Split (key, line) pairs into sorted runs that fit the memory budget.
+
+    reader :: generator((ANY, str))
+    bufferSize :: int
+        Memory budget in bytes.
+    reverse :: bool
+    spill :: bool
+        If True, every run except the last one is spilled to a temporary
+        file before the next one is filled, so only one run is in memory.
+    tmpDir :: str
+        Directory for temporary files.
+    return :: generator([(ANY, str)] or pysows.SpillFile)
+
+    """
+    getKey = lambda (x,y):x
+    run = []
+    size = 0
+    for sortKey, line in reader:
+        if size >= bufferSize:
+            run.sort(key=getKey, reverse=reverse)
+            if spill:
+                run = writeRun(run, tmpDir)
+            yield run
+            run = []
+            size = 0
+        run.append((sortKey, line))
+        size += sys.getsizeof(line) + getKeySize(sortKey) + ENTRY_OVERHEAD
+    run.sort(key=getKey, reverse=reverse)
+    yield run
+
+def mergeSortedRuns(runG, reverse=False, tmpDir=None):
+    """
+    Merge sorted runs into one sorted stream.
+    When MERGE_FANIN - 1 runs are kept, the newest runs of the lowest merge levels
+    are merged into a temporary file. So at most MERGE_FANIN files are open at once
+    and each pair is rewritten only about log(number of runs) times.
+
+    runG :: generator([(ANY, str)] or pysows.SpillFile)
+        Sorted runs in input order.
+    reverse :: bool
+    tmpDir :: str
+        Directory for temporary files.
+    return :: generator((ANY, str))
+
+    """
+    levelL = []
+    runL = []
+    for run in runG:
+        levelL.append(0)
+        runL.append(run)
+        if len(runL) >= MERGE_FANIN - 1:
+            # Levels never increase along runL, so this is a suffix of 2 runs or more.
+            level = levelL[-2]
+            i = len(runL) - 2
+            while i > 0 and levelL[i - 1] <= level:
+                i -= 1
+            runFile = writeRun(mergeRuns(runL[i:], reverse), tmpDir)
+            levelL[i:] = [level + 1]
+            runL[i:] = [runFile]
+    if len(runL) == 1:
+        return iter(runL[0])
+    return mergeRuns(runL, reverse)
+
+def reduceRuns(runL, maxNrRuns, reverse=False, tmpDir=None):
+    """
+    Merge runs into temporary files until at most maxNrRuns runs remain.
+    This keeps the number of open files bounded.
+
+    runL :: [iter((ANY, str))]
+    maxNrRuns :: int
+    reverse :: bool
+    tmpDir :: str
+    return :: [iter((ANY, str))]
+
+    """
+    assert maxNrRuns > 0
+    while len(runL) > maxNrRuns:
+        runL = [writeRun(mergeRuns(runL[i:i + MERGE_FANIN], reverse), tmpDir)
+                for i in xrange(0, len(runL), MERGE_FANIN)]
+    return runL
+
+def externalSorted(reader, bufferSize, reverse=False, tmpDir=None):
+    """
+    Sort (key, line) pairs using bounded memory.
+    Sorted runs are spilled to temporary files and k-way merged.
 
+    reader :: generator((ANY, str))
+        (key, line) generator. Keys must be picklable.
+    bufferSize :: int
+        Memory budget in bytes.
+    reverse :: bool
+    tmpDir :: str
+        Directory for temporary files.
+    return :: generator((ANY, str))
+
+    """
+    return mergeSortedRuns(sortedRuns(reader, bufferSize, reverse, True, tmpDir),
+                           reverse, tmpDir)
+
+def topSorted(reader, limit, reverse=False):
+    """
+    Get the first pairs of the sorted result with a bounded heap.
+    This is equivalent to sorted(reader, ...)[:limit] including tie order.
+
+    reader :: generator((ANY, str))
+    limit :: int
+    reverse :: bool
+    return :: [(ANY, str)]
+
+    """
+    if reverse:
+        return heapq.nlargest(limit, reader, key=lambda (x,y):x)
+    else:
+        return heapq.nsmallest(limit, reader, key=lambda (x,y):x)
+
+def getTestPairs():
+    """
+    return :: [(int, str)]
+        (key, line) pairs with many ties. Lines keep the input order.
+
+    """
+    return [((i * 7919) % 97, 'line%d' % i) for i in xrange(5000)]
+
+def testExternalSorted():
+    global MERGE_FANIN
+    pairL = getTestPairs()
+    getKey = lambda (x,y):x
+    spillFile = pysows.SpillFile
+    nrOpen = [0, 0] # open spill files and its peak.
+    class CountedSpillFile(spillFile):
+        def __init__(self, *args):
+            spillFile.__init__(self, *args)
+            nrOpen[0] += 1
+            nrOpen[1] = max(nrOpen)
+        def __iter__(self):
+            for item in spillFile.__iter__(self):
+                yield item
+            nrOpen[0] -= 1
+    for reverse in [False, True]:
+        expected = sorted(pairL, key=getKey, reverse=reverse)
+        assert list(externalSorted(iter(pairL), 1 << 30, reverse)) == expected
+        assert list(externalSorted(iter(pairL), 20000, reverse)) == expected
+        runL = list(sortedRuns(iter(pairL), 20000, reverse))
+        assert len(runL) > 3
+        assert list(mergeSortedRuns(iter(runL), reverse)) == expected
+        fanin = MERGE_FANIN
+        MERGE_FANIN = 3
+        pysows.SpillFile = CountedSpillFile
+        try:
+            assert list(mergeSortedRuns(iter(runL), reverse)) == expected
+            # Many more runs than MERGE_FANIN.
+            runG = sortedRuns(iter(pairL), 2000, reverse, True)
+            assert list(mergeSortedRuns(runG, reverse)) == expected
+            assert nrOpen == [0, MERGE_FANIN]
+            nrOpen[1] = 0
+        finally:
+            MERGE_FANIN = fanin
+            pysows.SpillFile = spillFile
+
+def testTopSorted():
+    pairL = getTestPairs()
+    getKey = lambda (x,y):x
+    for reverse in [False, True]:
+        expected = sorted(pairL, key=getKey, reverse=reverse)
+        for limit in [1, 100, 10000]:
+            assert topSorted(iter(pairL), limit, reverse) == expected[:limit]
+
+def generateSortKey(args):
+    """
+    Build key extraction from command-line options.
+
+    args :: argparse.Namespace
+    return :: str -> ANY
+        line without eol -> sort key.
+
+    """
+    sortSpecL = parseSortSpec(args.group_indexes)
     g = globals()
-    l = locals()
+    l = {}
     pysows.loadPythonCodeFile(args.load_file, g, l)
-    keyFunc = generateKeyFunc(args.key_func, g, l)
-    reader = sortKeyAndLineGenerator(convIdxL, keyFunc, sys.stdin, args.separator)
+    if args.cmp_func is not None:
+        cmpFunc = eval(args.cmp_func, g, l)
+    else:
+        cmpFunc = None
+    if args.key_func != DEFAULT_KEY_FUNC:
+        keyFunc = generateKeyFunc(args.key_func, g, l)
+    else:
+        keyFunc = None
+    if (cmpFunc is not None or keyFunc is not None) and \
+            any(isDesc for _, _, isDesc in sortSpecL):
+        raise IOError("':desc' cannot be used with -k or -c.")
+    return compileLineKey(sortSpecL, args.separator, keyFunc, cmpFunc)
+
+# Per-process state of parallel sort workers.
+workerState = None
+
+def initSortWorker(args):
+    """
+    Initializer of parallel sort worker processes.
+    Functions given as code strings cannot be pickled so each worker
+    builds them from the options by itself.
+
+    args :: argparse.Namespace
+
+    """
+    global workerState
+    workerState = (generateSortKey(args), args.reverse, args.limit, args.tmp_dir)
+
+def sortChunk(lineL):
+    """
+    Extract keys from a chunk of lines and sort it in a worker process.
+
+    lineL :: [str]
+    return :: [(ANY, str)]
+
+    """
+    getLineKey, reverse, limit, _ = workerState
+    reader = sortKeyAndLineGenerator(getLineKey, lineL)
+    if limit is not None:
+        return topSorted(reader, limit, reverse)
+    return sorted(reader, key=lambda (x,y):x, reverse=reverse)
+
+def parallelSortedRuns(lineG, args, nrWorkers, chunkSize):
+    """
+    Sort chunks of lines in a process pool.
+
+    lineG :: generator(str)
+    args :: argparse.Namespace
+    nrWorkers :: int
+    chunkSize :: int
+        Approximate chunk size in bytes.
+    return :: generator([(ANY, str)])
+        Sorted runs in input order.
+
+    """
+    chunkG = pysows.lineChunkGenerator(pysows.lineBatchReader(lineG), chunkSize)
+    return pysows.parallelImap(sortChunk, chunkG, nrWorkers, initSortWorker, (args,))
+
+def writeIndexedRun(pairL, workDir):
+    """
+    Write sorted (key, line) pairs to a run file in blocks.
+
+    pairL :: [(ANY, str)]
+    workDir :: str
+    return :: (str, [ANY], [int])
+        1st: path of the run file.
+        2nd: first key of each block.
+        3rd: offset of each block.
+
+    """
+    fd, path = tempfile.mkstemp(dir=workDir, prefix='run-')
+    firstKeyL = []
+    offsetL = []
+    with os.fdopen(fd, 'wb') as f:
+        for i in xrange(0, len(pairL), RUN_BLOCK_SIZE):
+            firstKeyL.append(pairL[i][0])
+            offsetL.append(f.tell())
+            cPickle.dump(pairL[i:i + RUN_BLOCK_SIZE], f, cPickle.HIGHEST_PROTOCOL)
+    return path, firstKeyL, offsetL
+
+def readRunRange(run, lower, upper, reverse=False):
+    """
+    Read the pairs of a run file whose keys are in [lower, upper).
+    Reading starts at the last block whose first key is below lower.
+
+    run :: (str, [ANY], [int])
+        Result of writeIndexedRun().
+    lower :: ANY or None
+        None means no lower bound.
+    upper :: ANY or None
+        None means no upper bound.
+    reverse :: bool
+        The run and the bounds are in descending order.
+    return :: generator((ANY, str))
+
+    """
+    path, firstKeyL, offsetL = run
+    if reverse:
+        wrap = ReverseKey
+    else:
+        wrap = lambda x: x
+    start = 0
+    if lower is not None:
+        wLower = wrap(lower)
+        while start + 1 < len(firstKeyL) and wrap(firstKeyL[start + 1]) < wLower:
+            start += 1
+    else:
+        wLower = None
+    if upper is not None:
+        wUpper = wrap(upper)
+    if not offsetL:
+        return
+    with open(path, 'rb') as f:
+        f.seek(offsetL[start])
+        for _ in xrange(start, len(offsetL)):
+            for key, line in cPickle.load(f):
+                wKey = wrap(key)
+                if wLower is not None and wKey < wLower:
+                    continue
+                if upper is not None and not wKey < wUpper:
+                    return
+                yield key, line
+
+def sortChunkToRun(lineL):
+    """
+    Sort a chunk of lines into an indexed run file in a worker process.
+
+    lineL :: [str]
+    return :: (str, [ANY], [int])
+        See writeIndexedRun().
+
+    """
+    getLineKey, reverse, _, tmpDir = workerState
+    pairL = sorted(sortKeyAndLineGenerator(getLineKey, lineL),
+                   key=lambda (x,y):x, reverse=reverse)
+    return writeIndexedRun(pairL, tmpDir)
 
-    for sortKey, line in sorted(reader, key=lambda (x,y):x, reverse=args.reverse):
-        print line
+def mergeRange((runL, lower, upper)):
+    """
+    Merge a key range of all the runs into a file of lines in a worker process.
+
+    runL :: [(str, [ANY], [int])]
+        Runs in input order.
+    lower :: ANY or None
+    upper :: ANY or None
+    return :: str
+        Path of the file of sorted lines.
+
+    """
+    _, reverse, _, tmpDir = workerState
+    readerL = [readRunRange(run, lower, upper, reverse) for run in runL]
+    readerL = reduceRuns(readerL, MERGE_FANIN, reverse, tmpDir)
+    fd, path = tempfile.mkstemp(dir=tmpDir, prefix='range-')
+    with os.fdopen(fd, 'wb') as f:
+        f.writelines(line + '\n' for _, line in mergeRuns(readerL, reverse))
+    return path
+
+def chooseSplitters(sampleL, nrRanges, reverse=False):
+    """
+    Choose keys that split samples into ranges of about the same size.
+
+    sampleL :: [ANY]
+    nrRanges :: int
+    reverse :: bool
+    return :: [ANY]
+        nrRanges - 1 keys in the sort order. Equal keys make empty ranges.
+
+    """
+    if not sampleL:
+        return []
+    sampleL = sorted(sampleL, reverse=reverse)
+    return [sampleL[len(sampleL) * i // nrRanges] for i in xrange(1, nrRanges)]
+
+def partitionedSortedText(lineG, args, nrWorkers, chunkSize):
+    """
+    Sort lines in a process pool with sampled range partitioning.
+    Workers sort chunks into run files whose block index is a sample of keys.
+    Splitters chosen from the samples divide keys into ranges,
+    and workers merge each range of all the runs.
+    Ranges are disjoint and ordered so they are just concatenated.
+
+    lineG :: generator(str)
+    args :: argparse.Namespace
+    nrWorkers :: int
+    chunkSize :: int
+        Approximate chunk size in bytes.
+    return :: generator(str)
+        Sorted text of each range.
+
+    """
+    workDir = tempfile.mkdtemp(dir=args.tmp_dir, prefix='pysows-sort-')
+    try:
+        # All the files of workers are put in workDir.
+        workerArgs = argparse.Namespace(**vars(args))
+        workerArgs.tmp_dir = workDir
+        runL = list(pysows.parallelImap(sortChunkToRun,
+                                        pysows.lineChunkGenerator(
+                                            pysows.lineBatchReader(lineG), chunkSize),
+                                        nrWorkers, initSortWorker, (workerArgs,)))
+        sampleL = list(itertools.chain.from_iterable(firstKeyL for _, firstKeyL, _ in runL))
+        splitterL = chooseSplitters(sampleL, nrWorkers * RANGES_PER_WORKER, args.reverse)
+        boundL = [None] + splitterL + [None]
+        taskG = ((runL, boundL[i], boundL[i + 1]) for i in xrange(len(boundL) - 1))
+        for path in pysows.parallelImap(mergeRange, taskG, nrWorkers,
+                                        initSortWorker, (workerArgs,)):
+            with open(path, 'rb') as f:
+                while True:
+                    buf = f.read(1 << 20)
+                    if not buf:
+                        break
+                    yield buf
+            os.remove(path)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+def testPartitionedSortedText():
+    global MERGE_FANIN
+    lineL = ['%d %d' % ((i * 7919) % 97, i) for i in xrange(5000)]
+    for opts, getKey, reverse in [
+            (['-g', 'i1'], lambda line: int(line.split()[0]), False),
+            (['-g', 'i1', '-r'], lambda line: int(line.split()[0]), True),
+            (['-g', '1', '-c', 'lambda x, y: cmp(y, x)'], lambda line: line.split()[0], True)]:
+        expected = sorted(lineL, key=getKey, reverse=reverse)
+        args = parseOpts(opts + ['-j', '2'])
+        generateSortKey(args)
+        for chunkSize in [1 << 20, 5000]:
+            text = ''.join(partitionedSortedText(iter(lineL), args, 2, chunkSize))
+            assert text.splitlines() == expected
+    fanin = MERGE_FANIN
+    MERGE_FANIN = 3
+    try:
+        text = ''.join(partitionedSortedText(iter(lineL), parseOpts(['-g', 'i1']), 2, 2000))
+        assert text.splitlines() == sorted(lineL, key=lambda line: int(line.split()[0]))
+    finally:
+        MERGE_FANIN = fanin
+
+def testReadRunRange():
+    workDir = tempfile.mkdtemp(prefix='pysows-sort-')
+    try:
+        pairL = sorted(getTestPairs(), key=lambda (x,y):x)
+        run = writeIndexedRun(pairL, workDir)
+        assert len(run[1]) == (len(pairL) + RUN_BLOCK_SIZE - 1) // RUN_BLOCK_SIZE
+        assert list(readRunRange(run, None, None)) == pairL
+        assert list(readRunRange(run, 10, 20)) == [p for p in pairL if 10 <= p[0] < 20]
+        assert list(readRunRange(run, 96, None)) == [p for p in pairL if p[0] >= 96]
+        pairL.reverse()
+        run = writeIndexedRun(pairL, workDir)
+        assert list(readRunRange(run, 20, 10, True)) == [p for p in pairL if 10 < p[0] <= 20]
+        splitterL = chooseSplitters(run[1], 4, True)
+        assert splitterL == sorted(splitterL, reverse=True) and len(splitterL) == 3
+        assert chooseSplitters([], 4) == []
+    finally:
+        shutil.rmtree(workDir)
+
+def sortLines(args, lineG):
+    """
+    Sort lines as the options say.
+
+    args :: argparse.Namespace
+    lineG :: generator(str)
+    return :: generator(str)
+        Pieces of the sorted text.
+
+    """
+    if args.buffer_size is None:
+        bufferSize = None
+    else:
+        bufferSize = util.u2s(args.buffer_size)
+
+    # This also sets CmpKey.cmpFunc which the merge in this process uses.
+    getLineKey = generateSortKey(args)
+    if args.parallel > 1:
+        if bufferSize is None:
+            chunkSize = pysows.PARALLEL_CHUNK_SIZE
+        else:
+            chunkSize = max(1, bufferSize // (2 * args.parallel))
+        if args.limit is None:
+            return partitionedSortedText(lineG, args, args.parallel, chunkSize)
+        # Only the first K lines of each chunk are merged.
+        runG = parallelSortedRuns(lineG, args, args.parallel, chunkSize)
+        result = itertools.islice(mergeSortedRuns(runG, args.reverse, args.tmp_dir),
+                                  args.limit)
+    else:
+        reader = sortKeyAndLineGenerator(getLineKey, lineG)
+        if args.limit is not None:
+            result = topSorted(reader, args.limit, args.reverse)
+        elif bufferSize is None:
+            result = sorted(reader, key=lambda (x,y):x, reverse=args.reverse)
+        else:
+            result = externalSorted(reader, bufferSize, args.reverse, args.tmp_dir)
+    return (line + '\n' for _, line in result)
+
+def testSortLinesWithCmpFuncInParallel():
+    lineL = ['%d %d' % ((i * 7919) % 500, i) for i in xrange(2000)]
+    expected = sorted(lineL, key=lambda line: int(line.split()[0]))
+    for opts in [[], ['-n', '10']]:
+        # The parent must not rely on a comparison function set by an earlier call.
+        CmpKey.cmpFunc = None
+        args = parseOpts(['-g', 'i1', '-c', 'lambda x, y: cmp(x, y)', '-j', '2',
+                          '-S', '4K'] + opts)
+        lines = ''.join(sortLines(args, iter(lineL))).splitlines()
+        assert lines == expected[:len(lines)]
+        assert len(lines) == (10 if opts else len(lineL))
+
+def doMain():
+    args = parseOpts(sys.argv[1:])
+    write = sys.stdout.write
+    for text in sortLines(args, sys.stdin):
+        write(text)
 
 if __name__ == "__main__":
     try: